@@ -0,0 +1,228 @@
+"""
+Benchmarks for the datasette-secrets read and write paths.
+
+    python benchmarks/bench_secrets.py --secrets 100 --versions 5 -o results.json
+
+Builds a Datasette instance with N registered secrets, each with M stored
+versions, against both an in-memory and a file-backed internal database, then
+measures get_secret() latency and throughput, /-/secrets render time and
+secrets_update POST throughput. Results are written as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from cryptography.fernet import Fernet
+from datasette import hookimpl, __version__ as datasette_version
+from datasette.app import Datasette
+from datasette.plugins import pm
+from datasette_secrets import Secret, get_keyring, get_secret, insert_secret_version
+
+ENCRYPTION_KEY = Fernet.generate_key().decode("utf-8")
+
+
+class BenchmarkSecretsPlugin:
+    __name__ = "BenchmarkSecretsPlugin"
+
+    def __init__(self, num_secrets):
+        self.names = ["BENCH_SECRET_{}".format(i) for i in range(num_secrets)]
+
+    @hookimpl
+    def register_secrets(self):
+        return [Secret(name) for name in self.names]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+    total = sum(timings)
+    return {
+        "count": len(timings),
+        "mean_ms": statistics.mean(timings) * 1000,
+        "p50_ms": percentile(0.5) * 1000,
+        "p95_ms": percentile(0.95) * 1000,
+        "p99_ms": percentile(0.99) * 1000,
+        "max_ms": timings[-1] * 1000,
+        "ops_per_second": len(timings) / total if total else None,
+    }
+
+
+async def build_datasette(internal, names, versions, cache):
+    plugin_config = {"encryption-key": ENCRYPTION_KEY}
+    if not cache:
+        plugin_config["cache"] = False
+    ds = Datasette(
+        internal=internal,
+        config={
+            "plugins": {"datasette-secrets": plugin_config},
+            "permissions": {"manage-secrets": {"id": "admin"}},
+        },
+    )
+    await ds.invoke_startup()
+    keyring = get_keyring(ds)
+    rows = []
+    for name in names:
+        for version in range(versions):
+            key_name, encrypted = keyring.encrypt("{}-v{}".format(name, version))
+            rows.append((name, "", encrypted, key_name, "admin"))
+
+    def seed(conn):
+        for row in rows:
+            insert_secret_version(conn, *row)
+
+    await ds.get_internal_database().execute_write_fn(seed)
+    return ds
+
+
+async def bench_get_secret(ds, names, iterations):
+    timings = []
+    for i in range(iterations):
+        name = names[i % len(names)]
+        start = time.perf_counter()
+        await get_secret(ds, name, "bench")
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+async def bench_get_secret_concurrent(ds, names, iterations, concurrency):
+    timings = []
+
+    async def worker(offset):
+        for i in range(offset, iterations, concurrency):
+            name = names[i % len(names)]
+            start = time.perf_counter()
+            await get_secret(ds, name, "bench")
+            timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    summary = summarize(timings)
+    summary["concurrency"] = concurrency
+    # Wall-clock throughput across all callers
+    summary["ops_per_second"] = len(timings) / elapsed
+    return summary
+
+
+async def bench_index(ds, iterations):
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "admin"})}
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = await ds.client.get("/-/secrets", cookies=cookies)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    return summarize(timings)
+
+
+async def bench_update(ds, names, iterations):
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "admin"})}
+    response = await ds.client.get("/-/secrets/{}".format(names[0]), cookies=cookies)
+    csrftoken = response.cookies.get("ds_csrftoken", "")
+    cookies["ds_csrftoken"] = csrftoken
+    timings = []
+    for i in range(iterations):
+        name = names[i % len(names)]
+        start = time.perf_counter()
+        response = await ds.client.post(
+            "/-/secrets/{}".format(name),
+            cookies=cookies,
+            data={"secret": "updated-{}".format(i), "note": "", "csrftoken": csrftoken},
+        )
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 302, response.status_code
+    return summarize(timings)
+
+
+async def run_scenario(internal, args, names, cache):
+    ds = await build_datasette(internal, names, args.versions, cache)
+    # Warm up
+    await bench_get_secret(ds, names, min(len(names), args.iterations))
+    return {
+        "get_secret": await bench_get_secret(ds, names, args.iterations),
+        "get_secret_concurrent": await bench_get_secret_concurrent(
+            ds, names, args.iterations, args.concurrency
+        ),
+        "index": await bench_index(ds, args.page_iterations),
+        "update": await bench_update(ds, names, args.page_iterations),
+    }
+
+
+async def run(args):
+    plugin = BenchmarkSecretsPlugin(args.secrets)
+    pm.register(plugin, name="BenchmarkSecretsPlugin")
+    scenarios = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for cache in (True, False):
+                suffix = "" if cache else "-nocache"
+                scenarios["memory" + suffix] = await run_scenario(
+                    None, args, plugin.names, cache
+                )
+                scenarios["file" + suffix] = await run_scenario(
+                    str(pathlib.Path(tmpdir) / "internal{}.db".format(suffix)),
+                    args,
+                    plugin.names,
+                    cache,
+                )
+    finally:
+        pm.unregister(name="BenchmarkSecretsPlugin")
+    return {
+        "parameters": {
+            "secrets": args.secrets,
+            "versions": args.versions,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "page_iterations": args.page_iterations,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "datasette": datasette_version,
+            "platform": platform.platform(),
+        },
+        "scenarios": scenarios,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--secrets", type=int, default=100, help="Registered secrets")
+    parser.add_argument(
+        "--versions", type=int, default=5, help="Stored versions of each secret"
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=2000, help="get_secret() calls per run"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=20, help="Concurrent get_secret() callers"
+    )
+    parser.add_argument(
+        "--page-iterations",
+        type=int,
+        default=50,
+        help="Index page renders and update POSTs per run",
+    )
+    parser.add_argument(
+        "-o", "--output", help="Write JSON results to this file instead of stdout"
+    )
+    args = parser.parse_args(argv)
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
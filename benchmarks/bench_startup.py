@@ -0,0 +1,165 @@
+"""
+Benchmarks for the startup cost that datasette-secrets adds to Datasette.
+
+    python benchmarks/bench_startup.py --runs 10 -o startup.json
+
+Each run uses a fresh Python process. It measures the import time of the
+datasette_secrets and cryptography packages, using python -X importtime, and
+the time taken to construct Datasette and run its startup hooks. Runs are made both
+without any datasette-secrets configuration and with an encryption key
+configured. The results record whether the cryptography library was imported
+and are written as JSON.
+"""
+
+import argparse
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+
+from datasette import __version__ as datasette_version
+
+ENCRYPTION_KEY = "-LujHtwFWGaBpznrV1zduoZBmCnMOW7J0H5hmeXgAVo="
+SCENARIOS = ("unconfigured", "configured")
+
+
+def child(scenario):
+    # Runs in a fresh process, printing one JSON result
+    import asyncio
+    import time
+
+    start = time.perf_counter()
+    from datasette.app import Datasette
+    import datasette_secrets
+
+    imported = time.perf_counter()
+    plugin_config = {}
+    if scenario == "configured":
+        plugin_config = {"datasette-secrets": {"encryption-key": ENCRYPTION_KEY}}
+    ds = Datasette(config={"plugins": plugin_config})
+
+    async def startup():
+        await ds.invoke_startup()
+        started = time.perf_counter()
+        crypto_after_startup = "cryptography.fernet" in sys.modules
+        first_get_ms = None
+        if scenario == "configured":
+            before = time.perf_counter()
+            await datasette_secrets.get_secret(ds, "MISSING")
+            first_get_ms = (time.perf_counter() - before) * 1000
+        return started, crypto_after_startup, first_get_ms
+
+    started, crypto_after_startup, first_get_ms = asyncio.run(startup())
+    sys.stdout.write(
+        json.dumps(
+            {
+                "import_datasette_ms": (imported - start) * 1000,
+                "startup_ms": (started - imported) * 1000,
+                "cryptography_imported_at_startup": crypto_after_startup,
+                "first_get_secret_ms": first_get_ms,
+            }
+        )
+    )
+
+
+def import_times_ms(packages):
+    """
+    Total import time of each package and its submodules, as reported by
+    python -X importtime for a process that imports datasette.app, which
+    loads every installed plugin
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import datasette.app"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    totals = dict.fromkeys(packages, 0)
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = [part.strip() for part in line[len("import time:") :].split("|")]
+        if len(parts) != 3 or not parts[0].isdigit():
+            continue
+        for package in packages:
+            if parts[2] == package or parts[2].startswith(package + "."):
+                totals[package] += int(parts[0]) / 1000
+    return totals
+
+
+def run_child(scenario):
+    completed = subprocess.run(
+        [sys.executable, __file__, "--child", scenario],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout)
+
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {
+        "mean_ms": statistics.mean(values),
+        "median_ms": statistics.median(values),
+        "min_ms": min(values),
+        "max_ms": max(values),
+    }
+
+
+def run(args):
+    packages = ("datasette_secrets", "cryptography")
+    import_runs = [import_times_ms(packages) for _ in range(args.runs)]
+    imports = {
+        package: summarize([run[package] for run in import_runs])
+        for package in packages
+    }
+    scenarios = {}
+    for scenario in SCENARIOS:
+        runs = [run_child(scenario) for _ in range(args.runs)]
+        scenarios[scenario] = {
+            "import_datasette": summarize([r["import_datasette_ms"] for r in runs]),
+            "startup": summarize([r["startup_ms"] for r in runs]),
+            "first_get_secret": summarize([r["first_get_secret_ms"] for r in runs]),
+            "cryptography_imported_at_startup": any(
+                r["cryptography_imported_at_startup"] for r in runs
+            ),
+        }
+    return {
+        "parameters": {"runs": args.runs},
+        "environment": {
+            "python": platform.python_version(),
+            "datasette": datasette_version,
+            "platform": platform.platform(),
+        },
+        "imports": imports,
+        "scenarios": scenarios,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--runs", type=int, default=10, help="Fresh processes per measurement"
+    )
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "-o", "--output", help="Write JSON results to this file instead of stdout"
+    )
+    args = parser.parse_args(argv)
+    if args.child:
+        child(args.child)
+        return
+    output = json.dumps(run(args), indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,530 @@
+import asyncio
 import click
-from cryptography.fernet import Fernet
 import dataclasses
+import json
 from datasette import hookimpl, Forbidden, Response
 from datasette.permissions import Action
 from datasette.plugins import pm
-from datasette.utils import await_me_maybe, sqlite3
+from datasette.utils import await_me_maybe, path_with_replaced_args
 import os
+import sys
+import time
+import types
 from typing import Optional
 from . import hookspecs
+from .cache import TTLCache
+from .keys import KeyRing
+from .listing import STATES, list_secrets
+from .metrics import Metrics
+from .retention import compact, compact_periodically
+from .transfer import ENV_PREFIX, format_env_line, read_env, read_jsonl
+from .rotation import rotate_key
+from .subscriptions import Subscriptions
+from .sync import SecretNotLoaded, SyncSecrets, refresh_periodically
+from .stores import FileSecretStore, SQLiteSecretStore
+from .usage import UsageRecorder
+
+# Not used here - re-exported for plugins, tests and the benchmarks
+from .migrations import SCHEMA
+from .stores import SecretStore, StoredSecret, insert_secret_version
 
 MAX_NOTE_LENGTH = 100
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CHANGE_CHECK_INTERVAL = 1
+DEFAULT_ACTOR_CACHE_TTL = 5 * 60
+DEFAULT_ACTOR_CACHE_SIZE = 1000
+DEFAULT_PERMISSION_CACHE_TTL = 10
+DEFAULT_PERMISSION_CACHE_SIZE = 1000
+DEFAULT_REGISTER_SECRETS_TIMEOUT = 10
+# Plugins that time out are retried after this many seconds, doubling each time
+REGISTRY_RETRY_DELAY = 1
+REGISTRY_RETRY_MAX_DELAY = 5 * 60
+DEFAULT_SYNC_REFRESH_INTERVAL = 60
+DEFAULT_USAGE_FLUSH_INTERVAL = 5
+DEFAULT_USAGE_FLUSH_SIZE = 100
+DEFAULT_COMPACT_INTERVAL = 60 * 60
+DEFAULT_COMPACT_BATCH_SIZE = 100
 
 pm.add_hookspecs(hookspecs)
 
 
 async def get_secret(datasette, secret_name, actor_id=None):
-    secrets_by_name = {secret.name: secret for secret in await get_secrets(datasette)}
-    if secret_name not in secrets_by_name:
-        return None
-    # Is it an environment secret?
-    env_var = "DATASETTE_SECRETS_{}".format(secret_name)
-    if os.environ.get(env_var):
-        return os.environ[env_var]
-    # Now look it up in the database
+    return (await get_secrets_many(datasette, [secret_name], actor_id))[secret_name]
+
+
+async def get_secrets_many(datasette, secret_names, actor_id=None):
+    """
+    Returns a dictionary mapping each of secret_names to its value, or None.
+
+    Looks up all of the secrets that are not set by environment variables or
+    already cached using a single call to the secret store, and records their
+    usage in one write. Secrets that are already being fetched by a concurrent
+    call are not fetched again - the result of that call is shared.
+    """
+    metrics = get_metrics(datasette)
+    results = dict.fromkeys(secret_names)
+    metrics.increment("lookups", len(results))
+    start = time.perf_counter()
+    registry = await get_registry(datasette)
+    end = time.perf_counter()
+    metrics.observe("registry", end - start, secret_names)
+    start = end
+    environment = get_environment_secrets(datasette)
+    to_fetch = []
+    for secret_name in results:
+        if secret_name not in registry:
+            continue
+        # Is it an environment secret?
+        env_value = environment.get(secret_name)
+        if env_value:
+            results[secret_name] = env_value
+        else:
+            to_fetch.append(secret_name)
+    metrics.observe("env", time.perf_counter() - start, secret_names)
+    env_found = [name for name, value in results.items() if value is not None]
+    if env_found:
+        metrics.increment("environment_hits", len(env_found))
+        metrics.record_reads(env_found)
+    if not to_fetch:
+        return results
+    # Now look them up in the cache and then the database
     config = get_config(datasette)
     if config is None:
-        return None
-    encryption_key = config["encryption_key"]
-    db = get_database(datasette)
-    try:
-        db_secret = (
-            await db.execute(
-                "select id, encrypted from datasette_secrets where name = ? order by version desc limit 1",
-                (secret_name,),
+        return results
+    cache = get_secret_cache(datasette)
+    found = {}
+    if cache is not None:
+        await revalidate_secret_cache(datasette)
+        for secret_name in to_fetch:
+            cached = cache.get(secret_name)
+            if cached is not None:
+                found[secret_name] = cached
+        metrics.increment("cache_hits", len(found))
+        metrics.increment("cache_misses", len(to_fetch) - len(found))
+    missing = [secret_name for secret_name in to_fetch if secret_name not in found]
+    if missing:
+        found.update(await _load_secrets_once(datasette, missing, cache))
+    for secret_name, cached in found.items():
+        results[secret_name] = cached.value
+    if found:
+        metrics.record_reads(list(found))
+        # Record last used timestamp and actor_id, written in batches
+        start = time.perf_counter()
+        await get_usage_recorder(datasette).record_many(
+            [cached.id for cached in found.values() if cached.id is not None],
+            actor_id,
+        )
+        metrics.observe("usage_write", time.perf_counter() - start, list(found))
+    return results
+
+
+async def _load_secrets(datasette, secret_names, cache):
+    # Fetch secret_names from the store in one call, decrypt them and cache them
+    metrics = get_metrics(datasette)
+    invalidations = getattr(datasette, "_secrets_invalidations", 0)
+    start = time.perf_counter()
+    stored = await get_store(datasette).get_many(secret_names)
+    end = time.perf_counter()
+    metrics.observe("db_fetch", end - start, secret_names)
+    start = end
+    found = {}
+    # Values fetched before a write must not be cached after it invalidated them
+    if getattr(datasette, "_secrets_invalidations", 0) != invalidations:
+        cache = None
+    if stored:
+        keyring = get_keyring(datasette)
+        for secret_name, secret in stored.items():
+            cached = CachedSecret(
+                id=secret.id,
+                version=secret.version,
+                value=keyring.decrypt(secret.encrypted, secret.encryption_key_name),
             )
-        ).first()
-    except sqlite3.OperationalError:
+            found[secret_name] = cached
+            if cache is not None:
+                cache.set(secret_name, cached)
+        metrics.observe("decrypt", time.perf_counter() - start, secret_names)
+    return found
+
+
+async def _load_secrets_once(datasette, secret_names, cache):
+    # Concurrent misses for the same secret share a single _load_secrets() task
+    inflight = getattr(datasette, "_secrets_inflight", None)
+    if inflight is None:
+        inflight = datasette._secrets_inflight = {}
+    tasks = {name: inflight[name] for name in secret_names if name in inflight}
+    if tasks:
+        get_metrics(datasette).increment("coalesced", len(tasks))
+    to_load = [name for name in secret_names if name not in tasks]
+    if to_load:
+        # Its own task, so cancelling any one caller cannot cancel the fetch
+        task = asyncio.ensure_future(_load_secrets(datasette, to_load, cache))
+        for name in to_load:
+            inflight[name] = task
+            tasks[name] = task
+
+        def done(task, names=to_load):
+            for name in names:
+                if inflight.get(name) is task:
+                    del inflight[name]
+            # Mark any exception as retrieved, in case every caller was cancelled
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(done)
+    found = {}
+    for name, task in tasks.items():
+        loaded = await asyncio.shield(task)
+        if name in loaded:
+            found[name] = loaded[name]
+    return found
+
+
+async def warm_secret_cache(datasette):
+    """
+    Fetch and decrypt the current version of every registered secret that is
+    not set by an environment variable, storing them in the cache.
+
+    At most cache-size secrets are loaded, in registration order. Returns a
+    dictionary with the number of secrets held in the cache, the number that
+    were skipped because they would not fit, and the time taken.
+    """
+    cache = get_secret_cache(datasette)
+    if cache is None:
         return None
-    if not db_secret:
+    start = time.perf_counter()
+    # Record the current generation before loading anything
+    await revalidate_secret_cache(datasette, force=True)
+    registry = await get_registry(datasette)
+    environment = get_environment_secrets(datasette)
+    names = [secret.name for secret in registry if secret.name not in environment]
+    # Loading more than fits would only evict the secrets loaded first
+    skipped = max(len(names) - cache.max_size, 0)
+    names = names[: cache.max_size]
+    found = await _load_secrets(datasette, names, cache) if names else {}
+    warm_up = {
+        "secrets": sum(1 for name in found if name in cache),
+        "skipped": skipped,
+        "duration_ms": (time.perf_counter() - start) * 1000,
+    }
+    get_metrics(datasette).warm_up = warm_up
+    return warm_up
+
+
+def get_secret_sync(datasette, secret_name):
+    """
+    Synchronous version of get_secret(), for use in hooks that cannot await.
+
+    Values are served from memory, kept up to date by a background task if
+    the sync-secrets setting is enabled - this never queries the database.
+    Returns None if the secret is not set, or raises SecretNotLoaded if it
+    has not been loaded yet.
+    """
+    registry = getattr(datasette, "_secrets_registry", None)
+    if registry is None:
+        raise SecretNotLoaded(secret_name)
+    if secret_name not in registry:
         return None
-    key = Fernet(encryption_key.encode("utf-8"))
-    decrypted = key.decrypt(db_secret["encrypted"])
-    # Update the last used timestamp and actor_id
-    params = (actor_id, db_secret["id"])
-    if not actor_id:
-        params = (db_secret["id"],)
-    await db.execute_write(
-        """
-        update datasette_secrets
-        set last_used_at = datetime('now'),
-            last_used_by = {}
-        where id = ?
-        """.format(
-            "?" if actor_id else "null"
-        ),
-        params,
+    env_value = get_environment_secrets(datasette).get(secret_name)
+    if env_value:
+        return env_value
+    return get_sync_secrets(datasette).get(secret_name)
+
+
+def get_sync_secrets(datasette):
+    sync_secrets = getattr(datasette, "_secrets_sync", None)
+    if sync_secrets is None:
+        sync_secrets = datasette._secrets_sync = SyncSecrets()
+    return sync_secrets
+
+
+async def refresh_sync_secrets(datasette):
+    """
+    Load the current value of every registered secret for get_secret_sync(),
+    using a single call to the secret store. Returns the number that are set.
+    """
+    if get_config(datasette) is None:
+        return 0
+    registry = await get_registry(datasette)
+    environment = get_environment_secrets(datasette)
+    names = [secret.name for secret in registry if secret.name not in environment]
+    refreshed_at = time.monotonic()
+    found = {}
+    if names:
+        found = await _load_secrets_once(datasette, names, get_secret_cache(datasette))
+    get_sync_secrets(datasette).replace(
+        {name: found[name].value if name in found else None for name in names},
+        refreshed_at,
+    )
+    return len(found)
+
+
+@dataclasses.dataclass(frozen=True)
+class CachedSecret:
+    id: Optional[int]
+    version: int
+    value: str
+
+
+def get_secret_cache(datasette):
+    "Returns the TTLCache of decrypted secrets for this instance, or None if disabled"
+    cache = getattr(datasette, "_secrets_cache", None)
+    if cache is not None:
+        return cache
+    config = get_config(datasette)
+    if config is None or not config["cache"]:
+        return None
+    cache = TTLCache(ttl=config["cache_ttl"], max_size=config["cache_size"])
+    datasette._secrets_cache = cache
+    return cache
+
+
+def get_keyring(datasette):
+    "Returns the KeyRing for this instance, or None if the plugin is not configured"
+    keyring = getattr(datasette, "_secrets_keyring", None)
+    if keyring is None:
+        config = get_config(datasette)
+        if config is None:
+            return None
+        keyring = KeyRing(config["encryption_keys"], config["encryption_key_name"])
+        datasette._secrets_keyring = keyring
+    return keyring
+
+
+async def rotate_encryption_key(
+    datasette, key_name=None, batch_size=100, on_batch=None
+):
+    """
+    Re-encrypt every stored secret version using key_name, or the configured
+    encryption-key-name. Resumes a previously interrupted rotation to that key.
+    """
+    keyring = get_keyring(datasette)
+    if keyring is None:
+        raise ValueError("datasette-secrets has not been configured")
+    return await rotate_key(
+        _require_sqlite_store(datasette).db,
+        keyring,
+        key_name=key_name,
+        batch_size=batch_size,
+        on_batch=on_batch,
+    )
+
+
+def _scan_environment():
+    return types.MappingProxyType(
+        {
+            key[len(ENV_PREFIX) :]: value
+            for key, value in os.environ.items()
+            if key.startswith(ENV_PREFIX) and value
+        }
+    )
+
+
+def get_environment_secrets(datasette):
+    """
+    Returns a read-only mapping of secret name to value for every non-empty
+    DATASETTE_SECRETS_* environment variable, as captured at startup.
+    """
+    environment = getattr(datasette, "_secrets_environment", None)
+    if environment is None:
+        environment = _scan_environment()
+        datasette._secrets_environment = environment
+    return environment
+
+
+def reload_environment_secrets(datasette):
+    """
+    Take a fresh snapshot of DATASETTE_SECRETS_* environment variables.
+
+    Returns the set of secret names that were added, removed or changed.
+    """
+    previous = getattr(datasette, "_secrets_environment", None) or {}
+    environment = _scan_environment()
+    datasette._secrets_environment = environment
+    changed = {
+        name
+        for name in set(previous) | set(environment)
+        if previous.get(name) != environment.get(name)
+    }
+    if changed:
+        get_subscriptions(datasette).notify(sorted(changed))
+    return changed
+
+
+def get_subscriptions(datasette):
+    subscriptions = getattr(datasette, "_secrets_subscriptions", None)
+    if subscriptions is None:
+        subscriptions = datasette._secrets_subscriptions = Subscriptions()
+    return subscriptions
+
+
+def subscribe_to_secret(datasette, secret_name, callback):
+    """
+    Call callback(secret_name) whenever a new version of the secret is saved,
+    or its environment variable changes. callback can be an async function.
+
+    Pass None as the secret_name to be called for changes to any secret.
+
+    Returns a function that can be called to unsubscribe.
+    """
+    return get_subscriptions(datasette).subscribe(secret_name, callback)
+
+
+async def watch_secret(datasette, secret_name, actor_id=None):
+    """
+    Async iterator that yields the new value of a secret each time it changes.
+
+    Changes that happen while the previous value is being handled are collapsed
+    into a single new value.
+    """
+    changed = asyncio.Event()
+    unsubscribe = subscribe_to_secret(datasette, secret_name, lambda _: changed.set())
+    try:
+        while True:
+            await changed.wait()
+            changed.clear()
+            yield await get_secret(datasette, secret_name, actor_id)
+    finally:
+        unsubscribe()
+
+
+async def compact_secrets(datasette, on_batch=None, **overrides):
+    """
+    Delete old versions of secrets according to the retention policy.
+
+    keep_versions=, keep_days=, batch_size= and vacuum= override the
+    configured keep-versions, keep-days, compact-batch-size and
+    incremental-vacuum settings. Returns the number of versions deleted.
+    """
+    config = get_config(datasette)
+    if config is None:
+        raise ValueError("datasette-secrets has not been configured")
+    options = {
+        "keep_versions": config["keep_versions"],
+        "keep_days": config["keep_days"],
+        "batch_size": config["compact_batch_size"],
+        "vacuum": config["incremental_vacuum"],
+    }
+    options.update(
+        {key: value for key, value in overrides.items() if value is not None}
+    )
+    db = _require_sqlite_store(datasette).db
+    return await compact(db, on_batch=on_batch, **options)
+
+
+def get_store(datasette):
+    "Returns the SecretStore selected by the store setting, default sqlite"
+    store = getattr(datasette, "_secrets_store", None)
+    if store is None:
+        plugin_config = datasette.plugin_config("datasette-secrets") or {}
+        store_name = plugin_config.get("store") or "sqlite"
+        store_classes = {}
+        for classes in pm.hook.register_secret_stores(datasette=datasette):
+            for store_class in classes:
+                store_classes.setdefault(store_class.name, store_class)
+        if store_name not in store_classes:
+            raise ValueError("Unknown datasette-secrets store: {}".format(store_name))
+        store = store_classes[store_name](datasette, plugin_config)
+        datasette._secrets_store = store
+    return store
+
+
+def _require_sqlite_store(datasette):
+    store = get_store(datasette)
+    if not isinstance(store, SQLiteSecretStore):
+        raise ValueError("This operation requires the sqlite store")
+    return store
+
+
+@hookimpl
+def register_secret_stores():
+    return [SQLiteSecretStore, FileSecretStore]
+
+
+def get_metrics(datasette):
+    metrics = getattr(datasette, "_secrets_metrics", None)
+    if metrics is None:
+        metrics = Metrics(datasette)
+        datasette._secrets_metrics = metrics
+    return metrics
+
+
+def get_usage_recorder(datasette):
+    recorder = getattr(datasette, "_secrets_usage_recorder", None)
+    if recorder is None:
+        config = get_config(datasette) or {}
+        recorder = UsageRecorder(
+            lambda rows: get_store(datasette).record_usage(rows),
+            interval=config.get("usage_flush_interval", DEFAULT_USAGE_FLUSH_INTERVAL),
+            max_pending=config.get("usage_flush_size", DEFAULT_USAGE_FLUSH_SIZE),
+        )
+        datasette._secrets_usage_recorder = recorder
+    return recorder
+
+
+async def flush_usage(datasette):
+    "Write any pending last_used_at / last_used_by updates to the database"
+    recorder = getattr(datasette, "_secrets_usage_recorder", None)
+    if recorder is None:
+        return 0
+    return await recorder.flush()
+
+
+def invalidate_secret_cache(datasette, secret_name=None):
+    "Drop one cached secret - or all of them if no name is provided"
+    # Fetches already under way may have read the old value: stop new callers
+    # from sharing them, and stop them from caching what they read
+    datasette._secrets_invalidations = (
+        getattr(datasette, "_secrets_invalidations", 0) + 1
     )
-    return decrypted.decode("utf-8")
+    inflight = getattr(datasette, "_secrets_inflight", None)
+    if inflight:
+        if secret_name is None:
+            inflight.clear()
+        else:
+            inflight.pop(secret_name, None)
+    cache = getattr(datasette, "_secrets_cache", None)
+    if cache is None:
+        return
+    if secret_name is None:
+        cache.clear()
+    else:
+        cache.pop(secret_name)
+
 
+async def revalidate_secret_cache(datasette, force=False):
+    """
+    Clear the cache if a secret has been changed by any process, as detected
+    by the store's generation(). This is checked at most once every
+    change-check-interval seconds, unless force is true.
 
-@dataclasses.dataclass
+    Returns True if the cache was cleared.
+    """
+    cache = getattr(datasette, "_secrets_cache", None)
+    if cache is None:
+        return False
+    now = time.monotonic()
+    checked_at = getattr(datasette, "_secrets_generation_checked_at", None)
+    if (
+        not force
+        and checked_at is not None
+        and now - checked_at < get_config(datasette)["change_check_interval"]
+    ):
+        return False
+    datasette._secrets_generation_checked_at = now
+    previous = getattr(datasette, "_secrets_generation", None)
+    generation = await get_store(datasette).generation()
+    datasette._secrets_generation = generation
+    if generation is None or previous is None or generation == previous:
+        return False
+    invalidate_secret_cache(datasette)
+    get_metrics(datasette).increment("cache_invalidations")
+    return True
+
+
+@dataclasses.dataclass(slots=True)
 class Secret:
     name: str
     description: Optional[str] = None
@@ -67,43 +532,157 @@ class Secret:
     obtain_label: Optional[str] = None
 
 
-SCHEMA = """
-create table if not exists datasette_secrets (
-    id integer primary key,
-    name text not null,
-    note text,
-    version integer not null default 1,
-    encrypted blob,
-    encryption_key_name text not null,
-    created_at text,
-    created_by text,
-    updated_at text,
-    updated_by text,
-    deleted_at text,
-    deleted_by text,
-    last_used_at text,
-    last_used_by text
-);
-"""
-
-
-def get_database(datasette):
-    plugin_config = datasette.plugin_config("datasette-secrets") or {}
-    database = plugin_config.get("database") or "_internal"
-    if database == "_internal" and hasattr(datasette, "get_internal_database"):
-        return datasette.get_internal_database()
-    return datasette.get_database(database)
+async def import_secrets(
+    datasette, records, actor_id=None, batch_size=100, on_batch=None
+):
+    """
+    Store a new version of each secret in records, an iterable of dictionaries
+    with name, secret and optional note keys. Returns the number imported.
+
+    Secrets are encrypted and stored batch_size at a time - for the sqlite
+    store that is one transaction per batch. on_batch(imported) is called
+    after each batch is committed.
+    """
+    keyring = get_keyring(datasette)
+    if keyring is None:
+        raise ValueError("datasette-secrets has not been configured")
+    store = get_store(datasette)
+    imported = 0
+
+    async def write(batch):
+        await store.put_many(batch)
+        names = list(dict.fromkeys(version["name"] for version in batch))
+        for name in names:
+            invalidate_secret_cache(datasette, name)
+        get_subscriptions(datasette).notify(names)
+
+    batch = []
+    for record in records:
+        encryption_key_name, encrypted = keyring.encrypt(record["secret"])
+        batch.append(
+            {
+                "name": record["name"],
+                "note": record.get("note") or "",
+                "encrypted": encrypted,
+                "encryption_key_name": encryption_key_name,
+                "actor_id": actor_id,
+            }
+        )
+        if len(batch) >= batch_size:
+            await write(batch)
+            imported += len(batch)
+            batch = []
+            if on_batch is not None:
+                on_batch(imported)
+    if batch:
+        await write(batch)
+        imported += len(batch)
+        if on_batch is not None:
+            on_batch(imported)
+    return imported
+
+
+async def export_secrets(datasette, plaintext=False, batch_size=100):
+    """
+    Async generator yielding a dictionary for the current version of every
+    stored secret, in name order, fetched batch_size secrets at a time.
+
+    Dictionaries include the encrypted token, or the decrypted secret if
+    plaintext=True.
+    """
+    keyring = get_keyring(datasette)
+    if keyring is None:
+        raise ValueError("datasette-secrets has not been configured")
+    store = get_store(datasette)
+    after = None
+    while True:
+        secrets = await store.list_current(after=after, limit=batch_size)
+        for secret in secrets:
+            record = {
+                "name": secret.name,
+                "version": secret.version,
+                "note": secret.note,
+                "encryption_key_name": secret.encryption_key_name,
+            }
+            if plaintext:
+                record["secret"] = keyring.decrypt(
+                    secret.encrypted, secret.encryption_key_name
+                )
+            else:
+                record["encrypted"] = secret.encrypted.decode("utf-8")
+            yield record
+        if len(secrets) < batch_size:
+            break
+        after = secrets[-1].name
 
 
 def get_config(datasette):
+    """
+    Returns the parsed datasette-secrets settings, or None if no encryption
+    keys are configured.
+
+    The settings are parsed once and stored on the instance - they are only
+    parsed again if datasette.config is replaced.
+    """
+    config = getattr(datasette, "config", None)
+    cached = getattr(datasette, "_secrets_config", None)
+    if cached is not None and cached[0] is config:
+        return cached[1]
+    parsed = _parse_config(datasette)
+    datasette._secrets_config = (config, parsed)
+    return parsed
+
+
+def _parse_config(datasette):
     plugin_config = datasette.plugin_config("datasette-secrets") or {}
     encryption_key = plugin_config.get("encryption-key")
-    database = plugin_config.get("database") or "_internal"
-    if not encryption_key:
+    encryption_keys = dict(plugin_config.get("encryption-keys") or {})
+    if encryption_key:
+        encryption_keys.setdefault("default", encryption_key)
+    if not encryption_keys:
         return None
+    encryption_key_name = plugin_config.get("encryption-key-name")
+    if not encryption_key_name:
+        # Use "default" if it exists, otherwise the last key listed
+        encryption_key_name = (
+            "default" if "default" in encryption_keys else list(encryption_keys)[-1]
+        )
     return {
-        "database": database,
-        "encryption_key": encryption_key,
+        "encryption_key": encryption_keys[encryption_key_name],
+        "encryption_keys": encryption_keys,
+        "encryption_key_name": encryption_key_name,
+        "cache": plugin_config.get("cache", True),
+        "cache_ttl": plugin_config.get("cache-ttl", DEFAULT_CACHE_TTL),
+        "cache_size": plugin_config.get("cache-size", DEFAULT_CACHE_SIZE),
+        "warm_cache": bool(plugin_config.get("warm-cache")),
+        "sync_secrets": bool(plugin_config.get("sync-secrets")),
+        "sync_refresh_interval": plugin_config.get(
+            "sync-refresh-interval", DEFAULT_SYNC_REFRESH_INTERVAL
+        ),
+        "actor_cache_ttl": plugin_config.get(
+            "actor-cache-ttl", DEFAULT_ACTOR_CACHE_TTL
+        ),
+        "permission_cache_ttl": plugin_config.get(
+            "permission-cache-ttl", DEFAULT_PERMISSION_CACHE_TTL
+        ),
+        "change_check_interval": plugin_config.get(
+            "change-check-interval", DEFAULT_CHANGE_CHECK_INTERVAL
+        ),
+        "usage_flush_interval": plugin_config.get(
+            "usage-flush-interval", DEFAULT_USAGE_FLUSH_INTERVAL
+        ),
+        "usage_flush_size": plugin_config.get(
+            "usage-flush-size", DEFAULT_USAGE_FLUSH_SIZE
+        ),
+        "keep_versions": plugin_config.get("keep-versions"),
+        "keep_days": plugin_config.get("keep-days"),
+        "compact_interval": plugin_config.get(
+            "compact-interval", DEFAULT_COMPACT_INTERVAL
+        ),
+        "compact_batch_size": plugin_config.get(
+            "compact-batch-size", DEFAULT_COMPACT_BATCH_SIZE
+        ),
+        "incremental_vacuum": bool(plugin_config.get("incremental-vacuum")),
     }
 
 
@@ -117,12 +696,96 @@ def register_actions(datasette):
     ]
 
 
-async def get_secrets(datasette):
+class SecretRegistry:
+    "All registered secrets, in registration order, indexed by name"
+
+    def __init__(self, secrets, plugins_key=None, timed_out=(), retries=0):
+        self.secrets = tuple(secrets)
+        self.by_name = {secret.name: secret for secret in self.secrets}
+        self.positions = {secret.name: i for i, secret in enumerate(self.secrets)}
+        self.plugins_key = plugins_key
+        # Names of plugins whose register_secrets() took too long
+        self.timed_out = tuple(timed_out)
+        self.retries = retries
+        self.retry_at = None
+        if self.timed_out:
+            delay = min(REGISTRY_RETRY_DELAY * 2**retries, REGISTRY_RETRY_MAX_DELAY)
+            self.retry_at = time.monotonic() + delay
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def position(self, name):
+        "Index of this secret in registration order, or -1 if not registered"
+        return self.positions.get(name, -1)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(self.secrets)
+
+    def __len__(self):
+        return len(self.secrets)
+
+
+def _plugins_key():
+    # Changes if a plugin implementing register_secrets is added or removed
+    return tuple(id(impl.plugin) for impl in pm.hook.register_secrets.get_hookimpls())
+
+
+_TIMED_OUT = object()
+
+
+async def _resolve_secrets(plugin_name, result, timeout):
+    try:
+        return await asyncio.wait_for(await_me_maybe(result), timeout)
+    except asyncio.TimeoutError:
+        sys.stderr.write(
+            "datasette-secrets: {} register_secrets() timed out after {}s\n".format(
+                plugin_name, timeout
+            )
+        )
+        sys.stderr.flush()
+        return _TIMED_OUT
+
+
+async def _build_secrets(datasette):
+    "Returns (secrets, timed_out_plugin_names)"
+    plugin_config = datasette.plugin_config("datasette-secrets") or {}
+    timeout = plugin_config.get(
+        "register-secrets-timeout", DEFAULT_REGISTER_SECRETS_TIMEOUT
+    )
+    # Call each plugin in hook order so results can be attributed to plugins.
+    # Each call goes through pluggy, so that wrapper implementations still apply.
+    impls = [
+        impl
+        for impl in pm.hook.register_secrets.get_hookimpls()
+        if not (impl.hookwrapper or impl.wrapper)
+    ]
+    pending = []
+    for impl in reversed(impls):
+        hook = pm.subset_hook_caller(
+            "register_secrets",
+            remove_plugins=[other.plugin for other in impls if other is not impl],
+        )
+        for result in hook(datasette=datasette):
+            pending.append((impl.plugin_name, result))
+    # Awaitable results are resolved concurrently
+    results = await asyncio.gather(
+        *(
+            _resolve_secrets(plugin_name, result, timeout)
+            for plugin_name, result in pending
+        )
+    )
     secrets = []
     seen = set()
-    for result in pm.hook.register_secrets(datasette=datasette):
-        result = await await_me_maybe(result)
-        for secret in result:
+    timed_out = []
+    for (plugin_name, _), result in zip(pending, results):
+        if result is _TIMED_OUT:
+            timed_out.append(plugin_name)
+            continue
+        for secret in result or ():
             if secret.name in seen:
                 continue  # Skip duplicates
             seen.add(secret.name)
@@ -130,7 +793,84 @@ async def get_secrets(datasette):
     # if not secrets:
     secrets.append(Secret("EXAMPLE_SECRET", "An example secret"))
 
-    return secrets
+    return secrets, timed_out
+
+
+async def get_registry(datasette, rebuild=False):
+    """
+    Returns the SecretRegistry for this Datasette instance, building it on first use.
+
+    The registry is rebuilt if plugins have been added or removed since it was
+    last built, or if rebuild=True is passed. If any plugins timed out it is
+    rebuilt in the background, with an increasing delay between attempts.
+    """
+    registry = getattr(datasette, "_secrets_registry", None)
+    plugins_key = _plugins_key()
+    if rebuild or registry is None or registry.plugins_key != plugins_key:
+        secrets, timed_out = await _build_secrets(datasette)
+        registry = SecretRegistry(secrets, plugins_key, timed_out)
+        datasette._secrets_registry = registry
+    elif registry.timed_out and time.monotonic() >= registry.retry_at:
+        retry = getattr(datasette, "_secrets_registry_retry", None)
+        if retry is None or retry.done():
+            datasette._secrets_registry_retry = asyncio.ensure_future(
+                _retry_registry(datasette, registry)
+            )
+    return registry
+
+
+async def _retry_registry(datasette, previous):
+    # Lookups keep using the previous registry until this finishes
+    try:
+        secrets, timed_out = await _build_secrets(datasette)
+    except Exception as ex:
+        sys.stderr.write("datasette-secrets registry retry failed: {}\n".format(ex))
+        sys.stderr.flush()
+        secrets, timed_out = previous.secrets, previous.timed_out
+    if getattr(datasette, "_secrets_registry", None) is previous:
+        datasette._secrets_registry = SecretRegistry(
+            secrets, previous.plugins_key, timed_out, retries=previous.retries + 1
+        )
+
+
+async def get_secrets(datasette):
+    return list(await get_registry(datasette))
+
+
+def datasette_options(fn):
+    "Options for commands that need to construct the Datasette instance"
+    for decorator in reversed(
+        (
+            click.argument("files", type=click.Path(exists=True), nargs=-1),
+            click.option(
+                "--internal",
+                type=click.Path(),
+                help="Path to the internal database, if secrets are stored there",
+            ),
+            click.option(
+                "-c",
+                "--config",
+                type=click.File("r"),
+                help="Datasette configuration file with the datasette-secrets settings",
+            ),
+        )
+    ):
+        fn = decorator(fn)
+    return fn
+
+
+def datasette_from_options(files, internal, config):
+    from datasette.app import Datasette
+    from datasette.utils import parse_metadata
+
+    ds = Datasette(
+        files,
+        internal=internal,
+        config=parse_metadata(config.read()) if config else None,
+    )
+    if get_config(ds) is None:
+        raise click.ClickException("datasette-secrets has not been configured")
+    return ds
 
 
 @hookimpl
@@ -142,91 +882,401 @@ def register_commands(cli):
     @secrets.command()
     def generate_encryption_key():
         "Generate a new encryption key for encrypting and decrypting secrets"
+        from cryptography.fernet import Fernet
+
         key = Fernet.generate_key()
         click.echo(key.decode("utf-8"))
 
+    @secrets.command()
+    @datasette_options
+    @click.option(
+        "--key-name",
+        help="Key to re-encrypt with, defaults to encryption-key-name",
+    )
+    @click.option(
+        "--batch-size",
+        type=int,
+        default=100,
+        show_default=True,
+        help="Number of rows to re-encrypt per transaction",
+    )
+    def rotate_key(files, internal, config, key_name, batch_size):
+        "Re-encrypt every stored secret using a different encryption key"
+        ds = datasette_from_options(files, internal, config)
+
+        def on_batch(last_id, rotated):
+            click.echo("Rotated {} rows, up to id {}".format(rotated, last_id))
+
+        async def run():
+            await ds.invoke_startup()
+            return await rotate_encryption_key(
+                ds, key_name=key_name, batch_size=batch_size, on_batch=on_batch
+            )
+
+        try:
+            rotated = asyncio.run(run())
+        except KeyError as ex:
+            raise click.ClickException(ex.args[0])
+        click.echo(
+            "Re-encrypted {} secret version{} using key {}".format(
+                rotated,
+                "" if rotated == 1 else "s",
+                key_name or get_keyring(ds).current_name,
+            )
+        )
+
+    @secrets.command()
+    @datasette_options
+    @click.option(
+        "--keep-versions",
+        type=click.IntRange(min=1),
+        help="Keep this many of the most recent versions of each secret",
+    )
+    @click.option(
+        "--keep-days",
+        type=click.IntRange(min=0),
+        help="Keep versions created within this many days",
+    )
+    @click.option(
+        "--batch-size",
+        type=int,
+        help="Number of rows to delete per transaction",
+    )
+    @click.option(
+        "--vacuum", is_flag=True, help="Run PRAGMA incremental_vacuum afterwards"
+    )
+    def compact(files, internal, config, keep_versions, keep_days, batch_size, vacuum):
+        "Delete old versions of secrets according to the retention policy"
+        ds = datasette_from_options(files, internal, config)
+        plugin_config = get_config(ds)
+        if keep_versions is None:
+            keep_versions = plugin_config["keep_versions"]
+        if keep_days is None:
+            keep_days = plugin_config["keep_days"]
+        if keep_versions is None and keep_days is None:
+            raise click.ClickException(
+                "No retention policy: use --keep-versions or --keep-days, "
+                "or the keep-versions or keep-days settings"
+            )
+
+        async def run():
+            await ds.invoke_startup()
+            return await compact_secrets(
+                ds,
+                keep_versions=keep_versions,
+                keep_days=keep_days,
+                batch_size=batch_size,
+                vacuum=vacuum or None,
+            )
+
+        deleted = asyncio.run(run())
+        click.echo(
+            "Deleted {} old secret version{}".format(
+                deleted, "" if deleted == 1 else "s"
+            )
+        )
+
+    @secrets.command(name="import")
+    @click.argument("input", type=click.File("r"))
+    @datasette_options
+    @click.option(
+        "--format",
+        "format_",
+        type=click.Choice(["jsonl", "env"]),
+        help="Input format, defaults to env for .env files and jsonl otherwise",
+    )
+    @click.option(
+        "--batch-size",
+        type=int,
+        default=100,
+        show_default=True,
+        help="Number of secrets to insert per transaction",
+    )
+    @click.option("--actor", help="Actor ID to record as having set the secrets")
+    def import_(input, files, internal, config, format_, batch_size, actor):
+        """
+        Import secrets from a JSON lines or .env file
+
+        JSON lines should look like {"name": "...", "secret": "...", "note": "..."}
+        """
+        ds = datasette_from_options(files, internal, config)
+        if format_ is None:
+            format_ = "env" if input.name.endswith(".env") else "jsonl"
+        # Read the whole file first, so an invalid line fails before any writes
+        try:
+            records = list((read_env if format_ == "env" else read_jsonl)(input))
+        except ValueError as ex:
+            raise click.ClickException(str(ex))
+
+        async def run():
+            await ds.invoke_startup()
+            return await import_secrets(
+                ds, records, actor_id=actor, batch_size=batch_size
+            )
+
+        try:
+            imported = asyncio.run(run())
+        except ValueError as ex:
+            raise click.ClickException(str(ex))
+        click.echo(
+            "Imported {} secret{}".format(imported, "" if imported == 1 else "s"),
+            err=True,
+        )
+
+    @secrets.command()
+    @datasette_options
+    @click.option(
+        "--plaintext",
+        is_flag=True,
+        help="Export decrypted secrets instead of encrypted tokens",
+    )
+    @click.option(
+        "--format",
+        "format_",
+        type=click.Choice(["jsonl", "env"]),
+        default="jsonl",
+        show_default=True,
+        help="Output format, env requires --plaintext",
+    )
+    @click.option(
+        "-o",
+        "--output",
+        type=click.File("w"),
+        default="-",
+        help="File to write to, defaults to standard output",
+    )
+    def export(files, internal, config, plaintext, format_, output):
+        "Export the current version of every stored secret"
+        if format_ == "env" and not plaintext:
+            raise click.ClickException("--format env requires --plaintext")
+        ds = datasette_from_options(files, internal, config)
+
+        async def run():
+            await ds.invoke_startup()
+            async for record in export_secrets(ds, plaintext=plaintext):
+                if format_ == "env":
+                    line = format_env_line(record["name"], record["secret"])
+                else:
+                    line = json.dumps(record)
+                output.write(line + "\n")
+
+        asyncio.run(run())
+
 
 @hookimpl
 def startup(datasette):
+    reload_environment_secrets(datasette)
     plugin_config = get_config(datasette)
     if not plugin_config:
         return
-    db = get_database(datasette)
+    # Check the key names up front - the keys are parsed on first use
+    get_keyring(datasette)
+    store = get_store(datasette)
 
-    async def create_table():
-        await db.execute_write(SCHEMA)
+    async def run_migrations():
+        await store.startup()
+        if plugin_config["warm_cache"]:
+            warm_up = await warm_secret_cache(datasette)
+            if warm_up is not None:
+                message = "datasette-secrets: warmed cache with {} secrets in {:.1f}ms"
+                message = message.format(warm_up["secrets"], warm_up["duration_ms"])
+                if warm_up["skipped"]:
+                    message += ", skipped {} that did not fit in cache-size".format(
+                        warm_up["skipped"]
+                    )
+                sys.stderr.write(message + "\n")
+                sys.stderr.flush()
+        if plugin_config["sync_secrets"]:
+            await refresh_sync_secrets(datasette)
+            wakeup = asyncio.Event()
+            # Refresh straight away when a secret changes in this process
+            get_subscriptions(datasette).subscribe(None, lambda _: wakeup.set())
+            datasette._secrets_sync_task = asyncio.ensure_future(
+                refresh_periodically(
+                    plugin_config["sync_refresh_interval"],
+                    lambda: refresh_sync_secrets(datasette),
+                    wakeup,
+                )
+            )
+        has_policy = (
+            plugin_config["keep_versions"] is not None
+            or plugin_config["keep_days"] is not None
+        ) and isinstance(store, SQLiteSecretStore)
+        if has_policy:
+            datasette._secrets_compaction_task = asyncio.ensure_future(
+                compact_periodically(
+                    plugin_config["compact_interval"],
+                    lambda: compact_secrets(datasette),
+                )
+            )
 
-    return create_table
+    return run_migrations
 
 
-async def secrets_index(datasette, request):
-    if not await datasette.allowed(
-        action="manage-secrets",
-        actor=request.actor,
+async def can_manage_secrets(datasette, actor):
+    """
+    Returns True if actor has the manage-secrets permission.
+
+    Results are cached per actor for permission-cache-ttl seconds. The cache
+    is cleared if the permissions configuration is replaced, or by calling
+    invalidate_permission_cache().
+    """
+    cache = getattr(datasette, "_secrets_permission_cache", None)
+    if cache is None:
+        config = get_config(datasette) or {}
+        cache = TTLCache(
+            ttl=config.get("permission_cache_ttl", DEFAULT_PERMISSION_CACHE_TTL),
+            max_size=DEFAULT_PERMISSION_CACHE_SIZE,
+        )
+        datasette._secrets_permission_cache = cache
+    # Compared by identity, which is cheaper than comparing the contents
+    permissions_config = (datasette.config or {}).get("permissions")
+    seen = getattr(datasette, "_secrets_permission_config", None)
+    if (
+        seen is None
+        or seen[0] is not datasette.config
+        or seen[1] is not permissions_config
     ):
-        raise Forbidden("Permission denied")
-    all_secrets = await get_secrets(datasette)
+        cache.clear()
+        datasette._secrets_permission_config = (datasette.config, permissions_config)
+    # Permissions can depend on any property of the actor, not just its ID
+    key = json.dumps(actor, sort_keys=True, default=repr)
+    allowed = cache.get(key)
+    if allowed is None:
+        allowed = bool(await datasette.allowed(action="manage-secrets", actor=actor))
+        cache.set(key, allowed)
+    return allowed
 
-    environment_secrets = []
-    for secret in all_secrets:
-        if os.environ.get("DATASETTE_SECRETS_{}".format(secret.name)):
-            environment_secrets.append(secret)
-    environment_secrets_names = {secret.name for secret in environment_secrets}
 
-    db = get_database(datasette)
-    existing_secrets_result = await db.execute(
-        """
-        select name, max(version) as version, updated_at, updated_by, note
-        from datasette_secrets
-        where name not in ({})
-        group by name
-        """.format(
-            ", ".join("?" for _ in environment_secrets_names)
-        ),
-        list(environment_secrets_names),
+def invalidate_permission_cache(datasette):
+    "Forget all cached manage-secrets permission checks"
+    cache = getattr(datasette, "_secrets_permission_cache", None)
+    if cache is not None:
+        cache.clear()
+
+
+async def get_actor_display_names(datasette, actor_ids):
+    """
+    Returns a dictionary mapping actor IDs to display names, using
+    datasette.actors_from_ids() where available.
+
+    Names are cached for actor-cache-ttl seconds, so only IDs that are not
+    in the cache are looked up.
+    """
+    if not actor_ids:
+        return {}
+    cache = getattr(datasette, "_secrets_actor_cache", None)
+    if cache is None:
+        config = get_config(datasette) or {}
+        cache = TTLCache(
+            ttl=config.get("actor_cache_ttl", DEFAULT_ACTOR_CACHE_TTL),
+            max_size=DEFAULT_ACTOR_CACHE_SIZE,
+        )
+        datasette._secrets_actor_cache = cache
+    display_names = {}
+    missing = []
+    for actor_id in actor_ids:
+        display_name = cache.get(actor_id)
+        if display_name is None:
+            missing.append(actor_id)
+        else:
+            display_names[actor_id] = display_name
+    if missing:
+        if hasattr(datasette, "actors_from_ids"):
+            actors = await datasette.actors_from_ids(missing)
+        else:
+            actors = {}
+        for actor_id in missing:
+            actor = actors.get(actor_id)
+            display_name = actor_id
+            if actor:
+                display_name = (
+                    actor.get("username") or actor.get("name") or actor.get("id")
+                )
+            cache.set(actor_id, display_name)
+            display_names[actor_id] = display_name
+    return display_names
+
+
+async def _secrets_page(datasette, request):
+    if not await can_manage_secrets(datasette, request.actor):
+        raise Forbidden("Permission denied")
+    state = request.args.get("state")
+    if state and state not in STATES:
+        raise ValueError("state must be one of {}".format(", ".join(STATES)))
+    size = request.args.get("_size") or DEFAULT_PAGE_SIZE
+    try:
+        size = int(size)
+    except ValueError:
+        raise ValueError("_size must be an integer")
+    if not 0 < size <= MAX_PAGE_SIZE:
+        raise ValueError("_size must be between 1 and {}".format(MAX_PAGE_SIZE))
+    prefix = request.args.get("prefix") or ""
+    items, next_cursor = await list_secrets(
+        get_store(datasette),
+        await get_registry(datasette),
+        get_environment_secrets(datasette),
+        states=(state,) if state else STATES,
+        prefix=prefix,
+        after=request.args.get("_next"),
+        size=size,
     )
-    existing_secrets = {row["name"]: dict(row) for row in existing_secrets_result.rows}
     # Try to turn updated_by into actors
-    if hasattr(datasette, "actors_from_ids"):
-        actors = await datasette.actors_from_ids(
-            {
-                row["updated_by"]
-                for row in existing_secrets.values()
-                if row["updated_by"]
-            }
+    display_names = await get_actor_display_names(
+        datasette, {item["updated_by"] for item in items if item["updated_by"]}
+    )
+    for item in items:
+        item["updated_by_display"] = display_names.get(
+            item["updated_by"], item["updated_by"]
         )
-        for secret in existing_secrets.values():
-            if secret["updated_by"]:
-                actor = actors.get(secret["updated_by"])
-                if actor:
-                    display = (
-                        actor.get("username") or actor.get("name") or actor.get("id")
-                    )
-                    secret["updated_by"] = display
-    unset_secrets = [
-        secret
-        for secret in all_secrets
-        if secret.name not in existing_secrets
-        and secret.name not in environment_secrets_names
-    ]
+    next_url = None
+    if next_cursor:
+        next_url = datasette.urls.path(
+            path_with_replaced_args(request, {"_next": next_cursor})
+        )
+    return {
+        "secrets": items,
+        "next": next_cursor,
+        "next_url": next_url,
+        "state": state,
+        "prefix": prefix,
+    }
+
+
+async def secrets_index(datasette, request):
+    try:
+        page = await _secrets_page(datasette, request)
+    except ValueError as ex:
+        return Response.html(str(ex), status=400)
+    items = page["secrets"]
     return Response.html(
         await datasette.render_template(
             "secrets_index.html",
             {
-                "existing_secrets": existing_secrets.values(),
-                "unset_secrets": unset_secrets,
-                "environment_secrets": environment_secrets,
+                "existing_secrets": [item for item in items if item["state"] == "set"],
+                "unset_secrets": [item for item in items if item["state"] == "unset"],
+                "environment_secrets": [
+                    item for item in items if item["state"] == "environment"
+                ],
+                "next_url": page["next_url"],
+                "state": page["state"],
+                "prefix": page["prefix"],
             },
             request=request,
         )
     )
 
 
+async def secrets_index_json(datasette, request):
+    try:
+        page = await _secrets_page(datasette, request)
+    except ValueError as ex:
+        return Response.json({"ok": False, "error": str(ex)}, status=400)
+    return Response.json({"ok": True, **page})
+
+
 async def secrets_update(datasette, request):
-    if not await datasette.allowed(
-        action="manage-secrets",
-        actor=request.actor,
-    ):
+    if not await can_manage_secrets(datasette, request.actor):
         raise Forbidden("Permission denied")
     plugin_config = get_config(datasette)
     if not plugin_config:
@@ -234,26 +1284,10 @@ async def secrets_update(datasette, request):
 
     secret_name = request.url_vars["secret_name"]
 
-    # Try and find a secret matching this name
-    secret_details = None
-    secrets = await get_secrets(datasette)
-    for s in secrets:
-        if s.name == secret_name:
-            secret_details = s
-            break
-
-    db = get_database(datasette)
+    secret_details = (await get_registry(datasette)).get(secret_name)
 
-    current_secret = (
-        await db.execute(
-            """
-        select * from datasette_secrets
-        where name = ?
-        order by version desc limit 1
-        """,
-            (secret_name,),
-        )
-    ).first()
+    store = get_store(datasette)
+    current_secret = await store.get(secret_name)
 
     if request.method == "POST":
         data = await request.post_vars()
@@ -267,17 +1301,8 @@ async def secrets_update(datasette, request):
         if not secret:
             if current_secret:
                 # Update the note
-                await db.execute_write(
-                    """
-                    update datasette_secrets
-                    set note = ?,
-                        updated_at = datetime('now'),
-                        updated_by = ?
-                    where id = ?
-                    """,
-                    (note, request.actor.get("id"), current_secret["id"]),
-                )
-                if note and note != current_secret["note"]:
+                await store.update_note(secret_name, note, request.actor.get("id"))
+                if note and note != current_secret.note:
                     datasette.add_message(
                         request, "Note updated: {}".format(secret_name)
                     )
@@ -286,41 +1311,21 @@ async def secrets_update(datasette, request):
                 datasette.add_message(request, "Secret is required", datasette.ERROR)
                 return Response.redirect(request.path)
 
-        encryption_key = plugin_config["encryption_key"]
-        key = Fernet(encryption_key.encode("utf-8"))
-        encrypted = key.encrypt(secret.encode("utf-8"))
-        encryption_key_name = "default"
+        encryption_key_name, encrypted = get_keyring(datasette).encrypt(secret)
         actor_id = request.actor.get("id")
-        await db.execute_write(
-            """
-            insert into datasette_secrets (
-                name, version, note, encrypted, encryption_key_name,
-                created_at, created_by, updated_at, updated_by
-            ) values (
-                ?,
-                coalesce((select max(version) + 1 from datasette_secrets where name = ?), 1),
-                ?,
-                ?,
-                ?,
-                -- created_at, created_by
-                datetime('now'), ?,
-                -- updated_at, updated_by
-                datetime('now'), ?
-            )
-            """,
-            (
-                secret_name,
-                secret_name,
-                note,
-                encrypted,
-                encryption_key_name,
-                actor_id,
-                actor_id,
-            ),
-        )
+        await store.put(secret_name, encrypted, encryption_key_name, note, actor_id)
+        invalidate_secret_cache(datasette, secret_name)
+        get_subscriptions(datasette).notify([secret_name])
         datasette.add_message(request, "Secret {} updated".format(secret_name))
         return Response.redirect(datasette.urls.path("/-/secrets"))
 
+    updated_by_display = None
+    if current_secret and current_secret.updated_by:
+        updated_by = current_secret.updated_by
+        updated_by_display = (await get_actor_display_names(datasette, [updated_by]))[
+            updated_by
+        ]
+
     return Response.html(
         await datasette.render_template(
             "secrets_update.html",
@@ -328,6 +1333,7 @@ async def secrets_update(datasette, request):
                 "secret_name": secret_name,
                 "secret_details": secret_details,
                 "current_secret": current_secret,
+                "updated_by_display": updated_by_display,
                 "max_note_length": MAX_NOTE_LENGTH,
             },
             request=request,
@@ -335,10 +1341,39 @@ async def secrets_update(datasette, request):
     )
 
 
+@hookimpl
+def asgi_wrapper(datasette):
+    # Flush pending usage updates when the server shuts down
+    def wrap_with_usage_flush(app):
+        async def wrapped_app(scope, receive, send):
+            if scope["type"] != "lifespan":
+                return await app(scope, receive, send)
+
+            async def wrapped_receive():
+                message = await receive()
+                if message["type"] == "lifespan.shutdown":
+                    await flush_usage(datasette)
+                return message
+
+            await app(scope, wrapped_receive, send)
+
+        return wrapped_app
+
+    return wrap_with_usage_flush
+
+
+async def secrets_metrics(datasette, request):
+    if not await can_manage_secrets(datasette, request.actor):
+        raise Forbidden("Permission denied")
+    return Response.json(get_metrics(datasette).to_dict())
+
+
 @hookimpl
 def register_routes():
     return [
+        (r"^/-/secrets/metrics\.json$", secrets_metrics),
         (r"^/-/secrets$", secrets_index),
+        (r"^/-/secrets\.json$", secrets_index_json),
         (r"^/-/secrets/(?P<secret_name>[^/]+)$", secrets_update),
     ]
 
@@ -350,10 +1385,7 @@ def menu_links(datasette, actor):
         return
 
     async def inner():
-        if not await datasette.allowed(
-            action="manage-secrets",
-            actor=actor,
-        ):
+        if not await can_manage_secrets(datasette, actor):
             return
         return [
             {"href": datasette.urls.path("/-/secrets"), "label": "Manage secrets"},
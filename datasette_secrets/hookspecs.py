@@ -6,3 +6,13 @@ hookspec = HookspecMarker("datasette")
 @hookspec
 def register_secrets(datasette):
     "Return a list of Secret instances, or an awaitable function returning that list"
+
+
+@hookspec
+def secrets_timing(datasette, phase, duration, secret_names):
+    "Called with the duration in seconds of each phase of a get_secret() lookup"
+
+
+@hookspec
+def register_secret_stores(datasette):
+    "Return a list of SecretStore subclasses that can be selected with the store setting"
@@ -0,0 +1,54 @@
+class KeyRing:
+    """
+    Named encryption keys, each parsed into a Fernet instance just once.
+
+    New secrets are encrypted using the key called current_name. Stored secrets
+    are decrypted using the key named in their encryption_key_name column,
+    falling back to trying every key if that name is not in the ring.
+
+    The cryptography library is only imported, and the keys parsed, the first
+    time something is encrypted or decrypted.
+    """
+
+    def __init__(self, keys, current_name):
+        if current_name not in keys:
+            raise KeyError("Unknown encryption key: {}".format(current_name))
+        self.current_name = current_name
+        self._keys = dict(keys)
+        self._fernets = None
+        self._fallback = None
+
+    def _setup(self):
+        from cryptography.fernet import Fernet, MultiFernet
+
+        fernets = {
+            name: Fernet(key.encode("utf-8") if isinstance(key, str) else key)
+            for name, key in self._keys.items()
+        }
+        # Current key first, so MultiFernet tries it first
+        self._fallback = MultiFernet(
+            [fernets[self.current_name]]
+            + [f for name, f in fernets.items() if name != self.current_name]
+        )
+        self._fernets = fernets
+
+    def __contains__(self, name):
+        return name in self._keys
+
+    @property
+    def names(self):
+        return list(self._keys)
+
+    def encrypt(self, plaintext, key_name=None):
+        "Returns (key_name, token) for plaintext encrypted with the named or current key"
+        if self._fernets is None:
+            self._setup()
+        key_name = key_name or self.current_name
+        token = self._fernets[key_name].encrypt(plaintext.encode("utf-8"))
+        return key_name, token
+
+    def decrypt(self, token, key_name=None):
+        if self._fernets is None:
+            self._setup()
+        fernet = self._fernets.get(key_name) or self._fallback
+        return fernet.decrypt(token).decode("utf-8")
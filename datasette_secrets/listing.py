@@ -0,0 +1,134 @@
+STATES = ("set", "unset", "environment")
+
+
+def parse_cursor(cursor):
+    "Cursors look like 'state:name' - the state and name of the last item returned"
+    if not cursor:
+        return None, None
+    state, _, name = cursor.partition(":")
+    if state not in STATES or not name:
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    return state, name
+
+
+def _item(secret, state, stored=None):
+    return {
+        "name": secret.name if secret else stored.name,
+        "state": state,
+        "description": secret.description if secret else None,
+        "obtain_url": secret.obtain_url if secret else None,
+        "obtain_label": secret.obtain_label if secret else None,
+        "version": stored.version if stored else None,
+        "note": stored.note if stored else None,
+        "updated_at": stored.updated_at if stored else None,
+        "updated_by": stored.updated_by if stored else None,
+    }
+
+
+async def _fetch_set(store, registry, environment, prefix, after, limit):
+    # Walks the store's current secrets in name order
+    items = []
+    while len(items) < limit:
+        stored = await store.list_current(after=after, prefix=prefix, limit=limit)
+        for secret in stored:
+            # Registered secrets set by environment variables are listed there
+            if secret.name in registry and secret.name in environment:
+                continue
+            items.append(_item(registry.get(secret.name), "set", secret))
+        if len(stored) < limit:
+            break
+        after = stored[-1].name
+    return items[:limit]
+
+
+def _registry_names(registry, prefix, after):
+    # Registered secrets in registration order, starting after the cursor
+    start = 0
+    if after is not None:
+        position = registry.position(after)
+        if position == -1:
+            # Restarting from the beginning would repeat earlier pages
+            raise ValueError("Stale cursor: {} is no longer registered".format(after))
+        start = position + 1
+    return (
+        secret for secret in registry.secrets[start:] if secret.name.startswith(prefix)
+    )
+
+
+async def _fetch_unset(store, registry, environment, prefix, after, limit):
+    items = []
+    secrets = _registry_names(registry, prefix, after)
+    exhausted = False
+    while len(items) < limit and not exhausted:
+        candidates = []
+        for secret in secrets:
+            if secret.name not in environment:
+                candidates.append(secret)
+                if len(candidates) >= limit:
+                    break
+        else:
+            exhausted = True
+        if not candidates:
+            break
+        set_names = await store.get_many([secret.name for secret in candidates])
+        items.extend(
+            _item(secret, "unset")
+            for secret in candidates
+            if secret.name not in set_names
+        )
+    return items[:limit]
+
+
+async def _fetch_environment(store, registry, environment, prefix, after, limit):
+    items = []
+    for secret in _registry_names(registry, prefix, after):
+        if secret.name in environment:
+            items.append(_item(secret, "environment"))
+            if len(items) >= limit:
+                break
+    return items
+
+
+FETCHERS = {
+    "set": _fetch_set,
+    "unset": _fetch_unset,
+    "environment": _fetch_environment,
+}
+
+
+async def list_secrets(
+    store, registry, environment, states=STATES, prefix="", after=None, size=100
+):
+    """
+    Returns (items, next_cursor) for one page of secrets.
+
+    Secrets are listed by state, in the order of states: stored secrets in name
+    order, then unset and environment secrets in registration order. Each page
+    only fetches the secrets it returns, so its cost does not depend on how many
+    secrets are registered or stored.
+    """
+    after_state, after_name = parse_cursor(after)
+    if after_state is not None and after_state not in states:
+        raise ValueError("Cursor does not match states: {}".format(after))
+    items = []
+    started = after_state is None
+    for state in states:
+        if not started:
+            if state != after_state:
+                continue
+            started = True
+            state_after = after_name
+        else:
+            state_after = None
+        items.extend(
+            await FETCHERS[state](
+                store, registry, environment, prefix, state_after, size + 1 - len(items)
+            )
+        )
+        if len(items) > size:
+            break
+    next_cursor = None
+    if len(items) > size:
+        items = items[:size]
+        next_cursor = "{}:{}".format(items[-1]["state"], items[-1]["name"])
+    return items, next_cursor
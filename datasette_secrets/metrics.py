@@ -0,0 +1,78 @@
+import bisect
+from collections import Counter
+from datasette.plugins import pm
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+
+class Histogram:
+    __slots__ = ("count", "total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        # One extra bucket for anything slower than the last bound
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+
+    def to_dict(self):
+        total_ms = self.total * 1000
+        return {
+            "count": self.count,
+            "total_ms": total_ms,
+            "mean_ms": total_ms / self.count if self.count else None,
+            "buckets": dict(
+                zip([str(bound) for bound in BUCKETS_MS] + ["+Inf"], self.buckets)
+            ),
+        }
+
+
+class Metrics:
+    """
+    In-process counters and latency histograms for the get_secret() hot path.
+
+    Each timing is also passed to any implementations of the secrets_timing()
+    plugin hook.
+    """
+
+    def __init__(self, datasette):
+        self.datasette = datasette
+        self.counters = Counter()
+        self.timings = {}
+        self.reads = Counter()
+        # Set by warm_secret_cache() at startup
+        self.warm_up = None
+
+    def increment(self, name, amount=1):
+        self.counters[name] += amount
+
+    def observe(self, phase, seconds, secret_names=None):
+        histogram = self.timings.get(phase)
+        if histogram is None:
+            histogram = self.timings[phase] = Histogram()
+        histogram.observe(seconds)
+        if pm.hook.secrets_timing.get_hookimpls():
+            pm.hook.secrets_timing(
+                datasette=self.datasette,
+                phase=phase,
+                duration=seconds,
+                secret_names=secret_names or [],
+            )
+
+    def record_reads(self, secret_names):
+        self.reads.update(secret_names)
+
+    def to_dict(self):
+        return {
+            "counters": dict(self.counters),
+            "timings": {
+                phase: histogram.to_dict() for phase, histogram in self.timings.items()
+            },
+            "reads": dict(self.reads),
+            "warm_up": self.warm_up,
+        }
@@ -0,0 +1,150 @@
+from .rotation import ROTATIONS_SCHEMA
+
+SCHEMA = """
+create table if not exists datasette_secrets (
+    id integer primary key,
+    name text not null,
+    note text,
+    version integer not null default 1,
+    encrypted blob,
+    encryption_key_name text not null,
+    created_at text,
+    created_by text,
+    updated_at text,
+    updated_by text,
+    deleted_at text,
+    deleted_by text,
+    last_used_at text,
+    last_used_by text
+);
+"""
+
+MIGRATIONS_SCHEMA = """
+create table if not exists datasette_secrets_migrations (
+    name text primary key,
+    applied_at text
+);
+"""
+
+MIGRATIONS = []
+
+
+def migration(fn):
+    "Register a migration - they are applied in the order they are defined"
+    MIGRATIONS.append(fn)
+    return fn
+
+
+@migration
+def m001_create_tables(conn):
+    # "if not exists" because these tables predate migrations
+    conn.execute(SCHEMA)
+    conn.execute(ROTATIONS_SCHEMA)
+
+
+@migration
+def m002_name_version_index(conn):
+    conn.execute("""
+        create unique index if not exists datasette_secrets_name_version
+        on datasette_secrets (name, version)
+        """)
+
+
+@migration
+def m003_current_versions(conn):
+    # Points at the current version of each secret, maintained on insert
+    conn.execute("""
+        create table if not exists datasette_secrets_current (
+            name text primary key,
+            secret_id integer not null references datasette_secrets(id)
+        )
+        """)
+    conn.execute("""
+        insert or replace into datasette_secrets_current (name, secret_id)
+        select name, id from datasette_secrets s
+        where version = (
+            select max(version) from datasette_secrets where name = s.name
+        )
+        """)
+
+
+@migration
+def m004_generation(conn):
+    # A counter bumped by any change to the current versions, so processes
+    # sharing the database can tell when their cached secrets are stale
+    conn.execute("""
+        create table if not exists datasette_secrets_generation (
+            id integer primary key check (id = 1),
+            generation integer not null
+        )
+        """)
+    conn.execute(
+        "insert or ignore into datasette_secrets_generation (id, generation) values (1, 0)"
+    )
+    for event in ("insert", "update", "delete"):
+        conn.execute("""
+            create trigger if not exists datasette_secrets_current_{event}
+            after {event} on datasette_secrets_current
+            begin
+                update datasette_secrets_generation set generation = generation + 1;
+            end
+            """.format(event=event))
+
+
+@migration
+def m005_rotation_superseded(conn):
+    # Set on unfinished rotations when a rotation to another key starts, as
+    # resuming them would skip rows that the later rotation re-encrypted
+    columns = {
+        row[1] for row in conn.execute("pragma table_info(datasette_secrets_rotations)")
+    }
+    if "superseded_at" not in columns:
+        conn.execute(
+            "alter table datasette_secrets_rotations add column superseded_at text"
+        )
+
+
+def applied_migrations(conn):
+    conn.execute(MIGRATIONS_SCHEMA)
+    return [
+        row[0]
+        for row in conn.execute(
+            "select name from datasette_secrets_migrations order by rowid"
+        )
+    ]
+
+
+def schema_version(conn):
+    "The number of migrations that have been applied to this database"
+    return len(applied_migrations(conn))
+
+
+def apply_migrations(conn):
+    """
+    Apply any pending migrations, returning the names of the ones that ran.
+
+    Manages its own transaction, so call it with transaction=False. The write
+    lock is taken before the applied migrations are read, so processes starting
+    at the same time against a shared database cannot both apply the same ones.
+    """
+    conn.execute("begin immediate")
+    try:
+        applied = set(applied_migrations(conn))
+        ran = []
+        for fn in MIGRATIONS:
+            if fn.__name__ in applied:
+                continue
+            fn(conn)
+            conn.execute(
+                """
+                insert into datasette_secrets_migrations (name, applied_at)
+                values (?, datetime('now'))
+                """,
+                (fn.__name__,),
+            )
+            ran.append(fn.__name__)
+    except BaseException:
+        conn.execute("rollback")
+        raise
+    conn.execute("commit")
+    return ran
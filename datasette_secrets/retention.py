@@ -0,0 +1,92 @@
+import asyncio
+import sys
+
+# Old versions of secrets that fall outside the retention policy. The current
+# version of a secret is never selected.
+EXPIRED_SQL = """
+select id from datasette_secrets s
+where id > :after
+and id not in (select secret_id from datasette_secrets_current)
+and (
+    (
+        :keep_versions is not null
+        and version <= (
+            select max(version) from datasette_secrets where name = s.name
+        ) - :keep_versions
+    )
+    or (
+        :keep_days is not null
+        and created_at < datetime('now', '-' || :keep_days || ' days')
+    )
+)
+order by id limit :limit
+"""
+
+
+async def compact(
+    db,
+    keep_versions=None,
+    keep_days=None,
+    batch_size=100,
+    vacuum=False,
+    on_batch=None,
+):
+    """
+    Delete old secret versions that fall outside the retention policy, returning
+    the number of rows deleted.
+
+    A version is deleted if it is not the current version and it is either not
+    one of the latest keep_versions versions of that secret or was created more
+    than keep_days days ago. Rows are deleted in batches of batch_size, each in
+    its own transaction. If vacuum is true PRAGMA incremental_vacuum is run
+    afterwards, which frees space if the database uses auto_vacuum=incremental.
+
+    on_batch(deleted) is called after each batch is committed.
+    """
+    if keep_versions is None and keep_days is None:
+        return 0
+    if keep_versions is not None and keep_versions < 1:
+        raise ValueError("keep_versions must be at least 1")
+    deleted = 0
+    after = 0
+    while True:
+        ids = [
+            row["id"]
+            for row in await db.execute(
+                EXPIRED_SQL,
+                {
+                    "after": after,
+                    "keep_versions": keep_versions,
+                    "keep_days": keep_days,
+                    "limit": batch_size,
+                },
+            )
+        ]
+        if not ids:
+            break
+        after = ids[-1]
+        cursor = await db.execute_write(
+            "delete from datasette_secrets where id in ({}) and id not in "
+            "(select secret_id from datasette_secrets_current)".format(
+                ", ".join("?" for _ in ids)
+            ),
+            ids,
+        )
+        deleted += cursor.rowcount
+        if on_batch is not None:
+            on_batch(deleted)
+    if vacuum and deleted:
+        await db.execute_write("pragma incremental_vacuum")
+    return deleted
+
+
+async def compact_periodically(interval, compact_fn):
+    "Call compact_fn() every interval seconds, forever"
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await compact_fn()
+        except Exception as ex:
+            # Keep going - the next run may succeed
+            sys.stderr.write("datasette-secrets compaction failed: {}\n".format(ex))
+            sys.stderr.flush()
@@ -0,0 +1,107 @@
+ROTATIONS_SCHEMA = """
+create table if not exists datasette_secrets_rotations (
+    id integer primary key,
+    encryption_key_name text not null,
+    last_id integer not null default 0,
+    rotated integer not null default 0,
+    started_at text,
+    completed_at text
+);
+"""
+
+
+async def rotate_key(db, keyring, key_name=None, batch_size=100, on_batch=None):
+    """
+    Re-encrypt every secret version in the datasette_secrets table using key_name,
+    defaulting to the key ring's current key. Returns the number of rows rotated.
+
+    Rows are processed in batches of batch_size, walking the table in id order.
+    Each batch is written in its own transaction along with the id of the last
+    row processed, so an interrupted rotation resumes where it stopped - unless a
+    rotation to a different key has been started since, in which case it is marked
+    as superseded and the rotation starts again from the first row.
+
+    on_batch(last_id, rotated) is called after each batch is committed.
+    """
+    key_name = key_name or keyring.current_name
+    if key_name not in keyring:
+        raise KeyError("Unknown encryption key: {}".format(key_name))
+
+    def start(conn):
+        # Only the most recent rotation can be resumed: any rotation since an
+        # unfinished one may have moved rows it had already passed to another key
+        latest = conn.execute("""
+            select id, encryption_key_name, last_id, rotated
+            from datasette_secrets_rotations
+            where completed_at is null and superseded_at is null
+            and id = (select max(id) from datasette_secrets_rotations)
+            """).fetchone()
+        if latest and latest[1] == key_name:
+            return latest[0], latest[2], latest[3]
+        conn.execute("""
+            update datasette_secrets_rotations set superseded_at = datetime('now')
+            where completed_at is null and superseded_at is null
+            """)
+        cursor = conn.execute(
+            """
+            insert into datasette_secrets_rotations (encryption_key_name, started_at)
+            values (?, datetime('now'))
+            """,
+            (key_name,),
+        )
+        return cursor.lastrowid, 0, 0
+
+    rotation_id, last_id, rotated = await db.execute_write_fn(start)
+
+    while True:
+        rows = (
+            await db.execute(
+                """
+                select id, encrypted, encryption_key_name from datasette_secrets
+                where id > ? and encryption_key_name != ?
+                order by id limit ?
+                """,
+                (last_id, key_name, batch_size),
+            )
+        ).rows
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            plaintext = keyring.decrypt(row["encrypted"], row["encryption_key_name"])
+            _, encrypted = keyring.encrypt(plaintext, key_name)
+            updates.append((encrypted, key_name, row["id"], row["encryption_key_name"]))
+        last_id = rows[-1]["id"]
+
+        def write_batch(conn):
+            conn.executemany(
+                """
+                update datasette_secrets
+                set encrypted = ?, encryption_key_name = ?
+                where id = ? and encryption_key_name = ?
+                """,
+                updates,
+            )
+            conn.execute(
+                """
+                update datasette_secrets_rotations
+                set last_id = ?, rotated = rotated + ?
+                where id = ?
+                """,
+                (last_id, len(updates), rotation_id),
+            )
+
+        await db.execute_write_fn(write_batch)
+        rotated += len(updates)
+        if on_batch is not None:
+            on_batch(last_id, rotated)
+
+    await db.execute_write(
+        """
+        update datasette_secrets_rotations
+        set completed_at = datetime('now')
+        where id = ?
+        """,
+        (rotation_id,),
+    )
+    return rotated
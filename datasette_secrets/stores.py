@@ -0,0 +1,495 @@
+import asyncio
+import bisect
+import contextlib
+import dataclasses
+import json
+import os
+import pathlib
+import tempfile
+from datasette.database import Database
+from datasette.utils import sqlite3
+from typing import Optional
+from .migrations import apply_migrations
+from .usage import utcnow
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the file store only supports a single writing process
+    fcntl = None
+
+
+@dataclasses.dataclass(slots=True)
+class StoredSecret:
+    "The current version of a secret, as held by a SecretStore"
+
+    name: str
+    version: int
+    encrypted: bytes
+    encryption_key_name: str
+    id: Optional[int] = None
+    note: Optional[str] = None
+    updated_at: Optional[str] = None
+    updated_by: Optional[str] = None
+
+
+class SecretStore:
+    """
+    Base class for secret storage backends.
+
+    Subclasses set name, which is used to select them with the "store" plugin
+    setting, and implement get_many(), put_many(), update_note() and
+    list_current(). Secrets are always passed in and returned encrypted.
+    """
+
+    name = None
+
+    def __init__(self, datasette, plugin_config):
+        self.datasette = datasette
+        self.plugin_config = plugin_config
+
+    async def startup(self):
+        "Called once when Datasette starts"
+
+    async def get(self, name):
+        "Returns the current StoredSecret for name, or None"
+        return (await self.get_many([name])).get(name)
+
+    async def get_many(self, names):
+        "Returns a dictionary mapping names to StoredSecret for those that are set"
+        raise NotImplementedError
+
+    async def put(self, name, encrypted, encryption_key_name, note="", actor_id=None):
+        "Store a new version of a secret and make it the current version"
+        await self.put_many(
+            [
+                {
+                    "name": name,
+                    "note": note,
+                    "encrypted": encrypted,
+                    "encryption_key_name": encryption_key_name,
+                    "actor_id": actor_id,
+                }
+            ]
+        )
+
+    async def put_many(self, versions):
+        """
+        Store new versions, a list of dictionaries with name, note, encrypted,
+        encryption_key_name and actor_id keys
+        """
+        raise NotImplementedError
+
+    async def update_note(self, name, note, actor_id=None):
+        "Change the note on the current version of a secret"
+        raise NotImplementedError
+
+    async def list_current(self, after=None, prefix="", limit=100):
+        "Returns up to limit current StoredSecrets in name order, after the name after"
+        raise NotImplementedError
+
+    async def record_usage(self, rows):
+        "Record (last_used_at, last_used_by, id) tuples - optional"
+
+    async def generation(self):
+        """
+        Returns a value that changes whenever another process changes a secret,
+        or None if the store cannot detect that - optional
+        """
+        return None
+
+
+INSERT_VERSION_SQL = """
+insert into datasette_secrets (
+    name, version, note, encrypted, encryption_key_name,
+    created_at, created_by, updated_at, updated_by
+) values (
+    :name,
+    coalesce((select max(version) + 1 from datasette_secrets where name = :name), 1),
+    :note,
+    :encrypted,
+    :encryption_key_name,
+    -- created_at, created_by
+    datetime('now'), :actor_id,
+    -- updated_at, updated_by
+    datetime('now'), :actor_id
+)
+"""
+
+UPDATE_USAGE_SQL = """
+update datasette_secrets
+set last_used_at = ?,
+    last_used_by = ?
+where id = ?
+"""
+
+
+def insert_secret_version(
+    conn, secret_name, note, encrypted, encryption_key_name, actor_id
+):
+    """
+    Insert a new version of a secret and make it the current version.
+
+    Call this inside a write transaction, e.g. using db.execute_write_fn()
+    """
+    cursor = conn.execute(
+        INSERT_VERSION_SQL,
+        {
+            "name": secret_name,
+            "note": note,
+            "encrypted": encrypted,
+            "encryption_key_name": encryption_key_name,
+            "actor_id": actor_id,
+        },
+    )
+    conn.execute(
+        """
+        insert or replace into datasette_secrets_current (name, secret_id)
+        values (?, ?)
+        """,
+        (secret_name, cursor.lastrowid),
+    )
+    return cursor.lastrowid
+
+
+def insert_secret_versions(conn, versions):
+    """
+    Insert many new secret versions using executemany, then point each secret
+    at its newest version. versions is a list of dictionaries with name, note,
+    encrypted, encryption_key_name and actor_id keys.
+
+    Call this inside a write transaction, e.g. using db.execute_write_fn()
+    """
+    conn.executemany(INSERT_VERSION_SQL, versions)
+    conn.executemany(
+        """
+        insert or replace into datasette_secrets_current (name, secret_id)
+        select name, id from datasette_secrets where name = ?
+        order by version desc limit 1
+        """,
+        [(name,) for name in dict.fromkeys(version["name"] for version in versions)],
+    )
+
+
+# Applied to the write connection of a dedicated database-file. auto_vacuum
+# only takes effect if it is set before any tables are created.
+DEDICATED_DATABASE_PRAGMAS = (
+    "pragma auto_vacuum = incremental",
+    "pragma journal_mode = wal",
+    "pragma synchronous = normal",
+    "pragma busy_timeout = 5000",
+)
+
+
+def configure_dedicated_database(conn):
+    for pragma in DEDICATED_DATABASE_PRAGMAS:
+        conn.execute(pragma)
+
+
+def _prefix_upper_bound(prefix):
+    # Smallest string greater than every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SQLiteSecretStore(SecretStore):
+    "Stores every version of every secret in the datasette_secrets table"
+
+    name = "sqlite"
+
+    def __init__(self, datasette, plugin_config):
+        super().__init__(datasette, plugin_config)
+        self.database = plugin_config.get("database") or "_internal"
+        self.database_file = plugin_config.get("database-file")
+        self._dedicated_db = None
+
+    @property
+    def db(self):
+        if self.database_file:
+            # Not added to datasette.databases, so it is hidden like _internal
+            if self._dedicated_db is None:
+                db = Database(self.datasette, path=str(self.database_file), mode="rwc")
+                db.name = "_secrets"
+                self._dedicated_db = db
+            return self._dedicated_db
+        if self.database == "_internal" and hasattr(
+            self.datasette, "get_internal_database"
+        ):
+            return self.datasette.get_internal_database()
+        return self.datasette.get_database(self.database)
+
+    async def startup(self):
+        if self.database_file:
+            await self.db.execute_write_fn(configure_dedicated_database)
+        await self.db.execute_write_fn(apply_migrations, transaction=False)
+
+    def _stored(self, row):
+        return StoredSecret(
+            id=row["id"],
+            name=row["name"],
+            version=row["version"],
+            encrypted=row["encrypted"],
+            encryption_key_name=row["encryption_key_name"],
+            note=row["note"],
+            updated_at=row["updated_at"],
+            updated_by=row["updated_by"],
+        )
+
+    async def get_many(self, names):
+        if not names:
+            return {}
+        try:
+            rows = (
+                await self.db.execute(
+                    """
+                    select s.id, s.name, s.version, s.encrypted, s.encryption_key_name,
+                    s.note, s.updated_at, s.updated_by
+                    from datasette_secrets_current c
+                    join datasette_secrets s on s.id = c.secret_id
+                    where c.name in ({})
+                    """.format(", ".join("?" for _ in names)),
+                    list(names),
+                )
+            ).rows
+        except sqlite3.OperationalError:
+            return {}
+        return {row["name"]: self._stored(row) for row in rows}
+
+    async def put_many(self, versions):
+        await self.db.execute_write_fn(
+            lambda conn: insert_secret_versions(conn, versions)
+        )
+
+    async def update_note(self, name, note, actor_id=None):
+        await self.db.execute_write(
+            """
+            update datasette_secrets
+            set note = ?,
+                updated_at = datetime('now'),
+                updated_by = ?
+            where id = (
+                select secret_id from datasette_secrets_current where name = ?
+            )
+            """,
+            (note, actor_id, name),
+        )
+
+    async def list_current(self, after=None, prefix="", limit=100):
+        # Walks datasette_secrets_current in name order, using its primary key
+        wheres = []
+        params = {"limit": limit}
+        if after is not None:
+            wheres.append("c.name > :after")
+            params["after"] = after
+        if prefix:
+            wheres.append("c.name >= :prefix and c.name < :prefix_upper")
+            params["prefix"] = prefix
+            params["prefix_upper"] = _prefix_upper_bound(prefix)
+        rows = (
+            await self.db.execute(
+                """
+                select s.id, s.name, s.version, s.encrypted, s.encryption_key_name,
+                s.note, s.updated_at, s.updated_by
+                from datasette_secrets_current c
+                join datasette_secrets s on s.id = c.secret_id
+                {}
+                order by c.name limit :limit
+                """.format(("where " + " and ".join(wheres)) if wheres else ""),
+                params,
+            )
+        ).rows
+        return [self._stored(row) for row in rows]
+
+    async def generation(self):
+        # Maintained by triggers on datasette_secrets_current
+        try:
+            return (
+                await self.db.execute(
+                    "select generation from datasette_secrets_generation"
+                )
+            ).single_value()
+        except sqlite3.OperationalError:
+            return None
+
+    async def record_usage(self, rows):
+        try:
+            await self.db.execute_write_many(UPDATE_USAGE_SQL, rows)
+        except sqlite3.OperationalError:
+            # Table is missing - nothing to record against
+            pass
+
+
+class FileSecretStore(SecretStore):
+    """
+    Keeps the current version of each secret in a JSON file, configured using
+    the store-file setting. Each secret is encrypted individually, just like
+    in the datasette_secrets table.
+
+    The file is read and indexed at startup and every lookup is served from
+    memory. Each lookup checks whether another process has replaced the file,
+    reloading it if so. Writes hold a lock on a .lock file next to it while
+    they reload, change and replace the file, so that writers in different
+    processes do not overwrite each other's changes.
+    """
+
+    name = "file"
+
+    def __init__(self, datasette, plugin_config):
+        super().__init__(datasette, plugin_config)
+        path = plugin_config.get("store-file")
+        if not path:
+            raise ValueError("The file store requires the store-file setting")
+        self.path = pathlib.Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self._secrets = None
+        self._names = []
+        self._loaded_mtime = None
+        self._lock = asyncio.Lock()
+
+    async def startup(self):
+        self._load()
+
+    def _mtime(self):
+        # Writes replace the file, so the inode changes even if the
+        # modification time is too coarse to show it
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _read(self):
+        secrets = {}
+        mtime = self._mtime()
+        if mtime is not None:
+            data = json.loads(self.path.read_text())
+            for name, details in data.get("secrets", {}).items():
+                secrets[name] = StoredSecret(
+                    name=name,
+                    version=details["version"],
+                    encrypted=details["encrypted"].encode("utf-8"),
+                    encryption_key_name=details["encryption_key_name"],
+                    note=details.get("note"),
+                    updated_at=details.get("updated_at"),
+                    updated_by=details.get("updated_by"),
+                )
+        return secrets, mtime
+
+    def _load(self):
+        self._set(*self._read())
+
+    def _set(self, secrets, mtime):
+        self._secrets = secrets
+        self._names = sorted(secrets)
+        self._loaded_mtime = mtime
+
+    def _ensure_loaded(self):
+        # Reload if this is the first use or another process replaced the file.
+        # A stat() is cheap enough to do on every call.
+        if self._secrets is None or self._mtime() != self._loaded_mtime:
+            self._load()
+        return self._secrets
+
+    def _write(self, secrets):
+        data = {
+            "secrets": {
+                name: {
+                    "version": secret.version,
+                    "encrypted": secret.encrypted.decode("utf-8"),
+                    "encryption_key_name": secret.encryption_key_name,
+                    "note": secret.note,
+                    "updated_at": secret.updated_at,
+                    "updated_by": secret.updated_by,
+                }
+                for name, secret in secrets.items()
+            }
+        }
+        # A unique name, so concurrent writers never share a temporary file
+        fp = tempfile.NamedTemporaryFile(
+            "w",
+            dir=self.path.parent,
+            prefix=self.path.name + ".",
+            suffix=".tmp",
+            delete=False,
+        )
+        try:
+            with fp:
+                fp.write(json.dumps(data, indent=2))
+            os.replace(fp.name, self.path)
+        except BaseException:
+            os.unlink(fp.name)
+            raise
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _locked_update(self, fn):
+        with self._file_lock():
+            secrets, mtime = self._secrets, self._loaded_mtime
+            if secrets is None or self._mtime() != mtime:
+                # Another process wrote since we last loaded the file
+                secrets, mtime = self._read()
+            # Copy on write, so readers never see a half-applied change
+            secrets = dict(secrets)
+            fn(secrets)
+            self._write(secrets)
+            return secrets, self._mtime()
+
+    async def _update(self, fn):
+        async with self._lock:
+            self._set(*await asyncio.to_thread(self._locked_update, fn))
+
+    async def generation(self):
+        self._ensure_loaded()
+        return self._loaded_mtime
+
+    async def get_many(self, names):
+        secrets = self._ensure_loaded()
+        return {name: secrets[name] for name in names if name in secrets}
+
+    async def put_many(self, versions):
+        def apply(secrets):
+            now = utcnow()
+            for version in versions:
+                previous = secrets.get(version["name"])
+                secrets[version["name"]] = StoredSecret(
+                    name=version["name"],
+                    version=previous.version + 1 if previous else 1,
+                    encrypted=version["encrypted"],
+                    encryption_key_name=version["encryption_key_name"],
+                    note=version["note"],
+                    updated_at=now,
+                    updated_by=version["actor_id"],
+                )
+
+        await self._update(apply)
+
+    async def update_note(self, name, note, actor_id=None):
+        def apply(secrets):
+            if name in secrets:
+                secrets[name] = dataclasses.replace(
+                    secrets[name], note=note, updated_at=utcnow(), updated_by=actor_id
+                )
+
+        await self._update(apply)
+
+    async def list_current(self, after=None, prefix="", limit=100):
+        self._ensure_loaded()
+        secrets, names = self._secrets, self._names
+        start = bisect.bisect_right(names, after) if after is not None else 0
+        if prefix:
+            start = max(start, bisect.bisect_left(names, prefix))
+        results = []
+        for name in names[start:]:
+            if not name.startswith(prefix) or len(results) >= limit:
+                break
+            results.append(secrets[name])
+        return results
@@ -0,0 +1,76 @@
+import asyncio
+import sys
+
+
+def _report(secret_name, ex):
+    sys.stderr.write(
+        "datasette-secrets: subscriber for {} failed: {!r}\n".format(secret_name, ex)
+    )
+    sys.stderr.flush()
+
+
+class Subscriptions:
+    """
+    Callbacks to run when secrets change, indexed by secret name.
+
+    Callbacks are called with the name of the secret that changed. Callbacks
+    subscribed with a secret_name of None are called for every secret. They can be
+    regular functions or async functions - async callbacks are run as tasks,
+    so a slow subscriber never delays the write that triggered it. Exceptions
+    raised by callbacks are written to stderr and otherwise ignored.
+    """
+
+    def __init__(self):
+        self._callbacks = {}
+        # References to running async callbacks, so they are not garbage collected
+        self._tasks = set()
+
+    def subscribe(self, secret_name, callback):
+        "Register callback for secret_name, returning a function that unsubscribes"
+        self._callbacks.setdefault(secret_name, []).append(callback)
+
+        def unsubscribe():
+            callbacks = self._callbacks.get(secret_name, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._callbacks.pop(secret_name, None)
+
+        return unsubscribe
+
+    def __contains__(self, secret_name):
+        return secret_name in self._callbacks
+
+    def notify(self, secret_names):
+        for secret_name in secret_names:
+            # Copied, so callbacks can unsubscribe themselves
+            callbacks = list(self._callbacks.get(secret_name, ()))
+            callbacks.extend(self._callbacks.get(None, ()))
+            for callback in callbacks:
+                try:
+                    result = callback(secret_name)
+                except Exception as ex:
+                    _report(secret_name, ex)
+                    continue
+                if asyncio.iscoroutine(result):
+                    self._run(secret_name, result)
+
+    def _run(self, secret_name, coroutine):
+        try:
+            task = asyncio.get_running_loop().create_task(coroutine)
+        except RuntimeError:
+            # No event loop, e.g. a reload from synchronous code
+            try:
+                asyncio.run(coroutine)
+            except Exception as ex:
+                _report(secret_name, ex)
+            return
+
+        self._tasks.add(task)
+
+        def done(task):
+            self._tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                _report(secret_name, task.exception())
+
+        task.add_done_callback(done)
@@ -0,0 +1,46 @@
+import asyncio
+import sys
+
+
+class SecretNotLoaded(LookupError):
+    "Raised by get_secret_sync() for a secret that has not been loaded yet"
+
+
+class SyncSecrets:
+    """
+    Decrypted values of registered secrets for get_secret_sync(), replaced as
+    a whole by each background refresh.
+
+    Reads never block and are safe from any thread, as the mapping is only
+    ever swapped for a new one. A value of None means the secret is not set.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self.refreshed_at = None
+
+    def replace(self, values, refreshed_at):
+        self._values = dict(values)
+        self.refreshed_at = refreshed_at
+
+    def get(self, secret_name):
+        values = self._values
+        if secret_name not in values:
+            raise SecretNotLoaded(secret_name)
+        return values[secret_name]
+
+
+async def refresh_periodically(interval, refresh_fn, wakeup):
+    "Call refresh_fn() every interval seconds, or sooner if wakeup is set"
+    while True:
+        try:
+            await asyncio.wait_for(wakeup.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        try:
+            await refresh_fn()
+        except Exception as ex:
+            # Keep serving the previous values - the next refresh may succeed
+            sys.stderr.write("datasette-secrets sync refresh failed: {}\n".format(ex))
+            sys.stderr.flush()
@@ -0,0 +1,83 @@
+import json
+import re
+
+ENV_PREFIX = "DATASETTE_SECRETS_"
+_PLAIN_ENV_VALUE = re.compile(r"[A-Za-z0-9_\-./:+@,=]*")
+# Escapes understood in double-quoted .env values - any other backslash is
+# kept as it is, so Windows paths like "C:\path" are read unchanged
+_ENV_ESCAPES = {
+    "\\": "\\",
+    '"': '"',
+    "'": "'",
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+}
+_ENV_ESCAPE = re.compile(r"\\(.)")
+_ENV_ESCAPED = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_ENV_NEEDS_ESCAPE = re.compile(r'[\\"\n\r\t]')
+
+
+def _unescape_env_value(value):
+    return _ENV_ESCAPE.sub(
+        lambda match: _ENV_ESCAPES.get(match.group(1), match.group(0)), value
+    )
+
+
+def _escape_env_value(value):
+    return _ENV_NEEDS_ESCAPE.sub(lambda match: _ENV_ESCAPED[match.group(0)], value)
+
+
+def read_jsonl(lines):
+    "Yield {name, secret, note} dictionaries from lines of newline-delimited JSON"
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as ex:
+            raise ValueError("Line {}: invalid JSON: {}".format(number, ex))
+        if not isinstance(record, dict) or not record.get("name"):
+            raise ValueError("Line {}: expected an object with a name".format(number))
+        if not record.get("secret"):
+            raise ValueError("Line {}: missing secret".format(number))
+        yield record
+
+
+def read_env(lines):
+    """
+    Yield {name, secret} dictionaries from the lines of a .env file
+
+    A DATASETTE_SECRETS_ prefix on names is removed.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("export "):
+            line = line[len("export ") :].lstrip()
+        name, sep, value = line.partition("=")
+        name = name.strip()
+        if not sep or not name:
+            raise ValueError("Line {}: expected NAME=value".format(number))
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = _unescape_env_value(value[1:-1])
+        elif len(value) >= 2 and value[0] == value[-1] == "'":
+            value = value[1:-1]
+        if name.startswith(ENV_PREFIX):
+            name = name[len(ENV_PREFIX) :]
+        if not value:
+            raise ValueError("Line {}: missing secret".format(number))
+        yield {"name": name, "secret": value}
+
+
+def format_env_line(name, value):
+    if not _PLAIN_ENV_VALUE.fullmatch(value):
+        value = '"{}"'.format(_escape_env_value(value))
+    return "{}={}".format(name, value)
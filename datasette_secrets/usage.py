@@ -0,0 +1,78 @@
+import asyncio
+import datetime
+import sys
+
+
+def utcnow():
+    # Same format as SQLite's datetime('now')
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class UsageRecorder:
+    """
+    Holds last_used_at / last_used_by updates in memory and passes them to
+    write_rows() as a single batch, either every interval seconds or as soon as
+    max_pending distinct rows are waiting.
+
+    Repeat uses of the same row between flushes collapse into one update that
+    keeps the most recent timestamp and actor.
+    """
+
+    def __init__(self, write_rows, interval, max_pending):
+        self._write_rows = write_rows
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def record(self, secret_id, actor_id=None):
+        await self.record_many([secret_id], actor_id)
+
+    async def record_many(self, secret_ids, actor_id=None):
+        last_used_at = utcnow()
+        for secret_id in secret_ids:
+            self._pending[secret_id] = (last_used_at, actor_id or None)
+        if self.interval <= 0 or len(self._pending) >= self.max_pending:
+            await self._flush_and_report()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.interval)
+        finally:
+            self._timer = None
+        await self._flush_and_report()
+
+    async def _flush_and_report(self):
+        # Failing to record usage should not fail the lookup that triggered it
+        try:
+            await self.flush()
+        except Exception as ex:
+            sys.stderr.write("datasette-secrets usage flush failed: {}\n".format(ex))
+            sys.stderr.flush()
+
+    async def flush(self):
+        """
+        Write all pending updates, returning the number of rows written.
+
+        If the write fails the updates are kept, to be retried by the next flush.
+        """
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [
+            (last_used_at, actor_id, secret_id)
+            for secret_id, (last_used_at, actor_id) in pending.items()
+        ]
+        try:
+            await self._write_rows(rows)
+        except BaseException:
+            # Updates recorded since the swap are newer, so they win
+            pending.update(self._pending)
+            self._pending = pending
+            raise
+        return len(rows)
@@ -1,12 +1,53 @@
+import asyncio
 from click.testing import CliRunner
 from cryptography.fernet import Fernet
 from datasette import hookimpl
 from datasette.cli import cli
 from datasette.plugins import pm
 from datasette_test import Datasette, actor_cookie
-from datasette_secrets import get_secret, Secret, startup, get_config
+from datasette_secrets import (
+    flush_usage,
+    compact_secrets,
+    get_actor_display_names,
+    get_config,
+    get_environment_secrets,
+    get_registry,
+    get_secret,
+    get_secret_sync,
+    get_secrets_many,
+    get_store,
+    invalidate_permission_cache,
+    invalidate_secret_cache,
+    reload_environment_secrets,
+    revalidate_secret_cache,
+    refresh_sync_secrets,
+    rotate_encryption_key,
+    SecretNotLoaded,
+    Secret,
+    startup,
+    subscribe_to_secret,
+    warm_secret_cache,
+    watch_secret,
+)
+from datasette_secrets.cache import TTLCache
+from datasette_secrets.stores import FileSecretStore, SecretStore, StoredSecret
+from datasette_secrets.keys import KeyRing
+from datasette_secrets.transfer import read_env
+from datasette_secrets.usage import UsageRecorder
+from datasette_secrets.migrations import (
+    MIGRATIONS,
+    SCHEMA,
+    apply_migrations,
+    schema_version,
+)
 import pytest
 from unittest.mock import ANY
+import json
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 
 TEST_ENCRYPTION_KEY = "-LujHtwFWGaBpznrV1zduoZBmCnMOW7J0H5hmeXgAVo="
 
@@ -244,6 +285,7 @@ async def test_get_secret(ds, monkeypatch):
     assert post_response.status_code == 302
 
     assert await get_secret(ds, "EXAMPLE_SECRET", "actor") == "manually-set-secret"
+    await flush_usage(ds)
 
     # Should have updated last_used_at and last_used_by
     secret = (
@@ -257,6 +299,7 @@ async def test_get_secret(ds, monkeypatch):
 
     # Calling again without actor ID should set that to null
     assert await get_secret(ds, "EXAMPLE_SECRET") == "manually-set-secret"
+    await flush_usage(ds)
     secret2 = (
         await db.execute(
             "select * from datasette_secrets where name = ? order by version desc limit 1",
@@ -267,6 +310,7 @@ async def test_get_secret(ds, monkeypatch):
 
     # Now over-ride with an environment variable
     monkeypatch.setenv("DATASETTE_SECRETS_EXAMPLE_SECRET", "from env")
+    reload_environment_secrets(ds)
 
     assert await get_secret(ds, "EXAMPLE_SECRET") == "from env"
 
@@ -281,7 +325,10 @@ async def test_get_secret(ds, monkeypatch):
 
     # Finally it should still work even if the datasette_secrets table is missing
     await db.execute_write("drop table datasette_secrets")
+    # Dropping the table directly bypasses cache invalidation
+    invalidate_secret_cache(ds)
     monkeypatch.delenv("DATASETTE_SECRETS_EXAMPLE_SECRET")
+    reload_environment_secrets(ds)
     assert await get_secret(ds, "EXAMPLE_SECRET") is None
 
 
@@ -326,3 +373,1553 @@ async def test_secret_index_page(ds, register_multiple_secrets):
 
 def remove_whitespace(s):
     return " ".join(s.split())
+
+
+async def set_secret(ds, secret_name, secret, note=""):
+    cookies = {"ds_actor": actor_cookie(ds, {"id": "admin"})}
+    get_response = await ds.client.get(
+        "/-/secrets/{}".format(secret_name), cookies=cookies
+    )
+    csrftoken = get_response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+    post_response = await ds.client.post(
+        "/-/secrets/{}".format(secret_name),
+        cookies=cookies,
+        data={"secret": secret, "note": note, "csrftoken": csrftoken},
+    )
+    assert post_response.status_code == 302
+
+
+def encrypt(value):
+    return Fernet(TEST_ENCRYPTION_KEY.encode("utf-8")).encrypt(value.encode("utf-8"))
+
+
+@pytest.mark.asyncio
+async def test_get_secret_cache(ds):
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "one"
+    # Change the stored value behind the plugin's back - cached value is used
+    db = get_internal_database(ds)
+    await db.execute_write(
+        "update datasette_secrets set encrypted = ?", (encrypt("sneaky"),)
+    )
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "one"
+    # Saving a new version through the UI invalidates the cache
+    await set_secret(ds, "EXAMPLE_SECRET", "two")
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "two"
+
+
+@pytest.mark.asyncio
+async def test_get_secret_cache_disabled():
+    ds = Datasette(
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-key": TEST_ENCRYPTION_KEY,
+                "cache": False,
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "one"
+    db = get_internal_database(ds)
+    await db.execute_write(
+        "update datasette_secrets set encrypted = ?", (encrypt("two"),)
+    )
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "two"
+
+
+def test_ttl_cache():
+    now = [0]
+    cache = TTLCache(ttl=10, max_size=2, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # Adding a third evicts the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    now[0] = 11
+    assert cache.get("a") is None
+    assert len(cache) == 1
+
+
+@pytest.mark.asyncio
+async def test_registry_is_memoized(ds, register_multiple_secrets):
+    calls = []
+
+    class CountingPlugin:
+        __name__ = "CountingPlugin"
+
+        @hookimpl
+        def register_secrets(self):
+            calls.append(1)
+            return [Secret(name="COUNTED")]
+
+    pm.register(CountingPlugin(), name="CountingPlugin")
+    try:
+        registry = await get_registry(ds)
+        assert registry.get("COUNTED").name == "COUNTED"
+        assert "OPENCAGE_API_KEY" in registry
+        assert await get_registry(ds) is registry
+        await get_secret(ds, "COUNTED")
+        assert len(calls) == 1
+        # Explicit rebuild
+        assert await get_registry(ds, rebuild=True) is not registry
+        assert len(calls) == 2
+    finally:
+        pm.unregister(name="CountingPlugin")
+    # Removing a plugin triggers a rebuild
+    assert "COUNTED" not in await get_registry(ds)
+    assert not hasattr(Secret("X"), "__dict__")
+
+
+@pytest.mark.asyncio
+async def test_usage_is_written_in_batches(ds):
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    db = get_internal_database(ds)
+
+    async def last_used():
+        row = (
+            await db.execute("select last_used_at, last_used_by from datasette_secrets")
+        ).first()
+        return dict(row)
+
+    assert await get_secret(ds, "EXAMPLE_SECRET", "alice") == "one"
+    assert await get_secret(ds, "EXAMPLE_SECRET", "bob") == "one"
+    # Nothing written yet
+    assert await last_used() == {"last_used_at": None, "last_used_by": None}
+    # Both reads collapse into a single row update with the latest actor
+    assert await flush_usage(ds) == 1
+    used = await last_used()
+    assert used["last_used_by"] == "bob"
+    assert used["last_used_at"] is not None
+    assert await flush_usage(ds) == 0
+
+
+@pytest.mark.asyncio
+async def test_usage_flushed_at_size_threshold(register_multiple_secrets):
+    ds = Datasette(
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-key": TEST_ENCRYPTION_KEY,
+                "usage-flush-size": 2,
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await set_secret(ds, "OPENAI_API_KEY", "two")
+    db = get_internal_database(ds)
+    await get_secret(ds, "EXAMPLE_SECRET", "alice")
+    await get_secret(ds, "OPENAI_API_KEY", "alice")
+    rows = await db.execute(
+        "select name from datasette_secrets where last_used_by = 'alice'"
+    )
+    assert {row["name"] for row in rows} == {"EXAMPLE_SECRET", "OPENAI_API_KEY"}
+
+
+@pytest.mark.asyncio
+async def test_usage_flushed_on_shutdown(ds):
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await get_secret(ds, "EXAMPLE_SECRET", "alice")
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await ds.app()({"type": "lifespan"}, receive, send)
+    assert sent[-1] == {"type": "lifespan.shutdown.complete"}
+    db = get_internal_database(ds)
+    row = (await db.execute("select last_used_by from datasette_secrets")).first()
+    assert row["last_used_by"] == "alice"
+
+
+@pytest.mark.asyncio
+async def test_get_secrets_many(ds, register_multiple_secrets, monkeypatch):
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await set_secret(ds, "OPENAI_API_KEY", "two")
+    await set_secret(ds, "OPENAI_API_KEY", "three")
+    monkeypatch.setenv("DATASETTE_SECRETS_OPENCAGE_API_KEY", "from env")
+    reload_environment_secrets(ds)
+    assert await get_secrets_many(
+        ds,
+        [
+            "EXAMPLE_SECRET",
+            "OPENAI_API_KEY",
+            "OPENCAGE_API_KEY",
+            "ANTHROPIC_API_KEY",
+            "NOT_REGISTERED",
+        ],
+        "alice",
+    ) == {
+        "EXAMPLE_SECRET": "one",
+        "OPENAI_API_KEY": "three",
+        "OPENCAGE_API_KEY": "from env",
+        "ANTHROPIC_API_KEY": None,
+        "NOT_REGISTERED": None,
+    }
+    # Usage for both database secrets recorded in one batch
+    assert await flush_usage(ds) == 2
+    db = get_internal_database(ds)
+    rows = await db.execute(
+        "select name, version from datasette_secrets where last_used_by = 'alice'"
+    )
+    assert {(row["name"], row["version"]) for row in rows} == {
+        ("EXAMPLE_SECRET", 1),
+        ("OPENAI_API_KEY", 2),
+    }
+
+
+@pytest.mark.asyncio
+async def test_multiple_encryption_keys():
+    old_key = Fernet.generate_key().decode("utf-8")
+    ds = Datasette(
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-keys": {"old": old_key, "new": TEST_ENCRYPTION_KEY},
+                "encryption-key-name": "new",
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+    config = get_config(ds)
+    assert config["encryption_key_name"] == "new"
+    assert config["encryption_key"] == TEST_ENCRYPTION_KEY
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    db = get_internal_database(ds)
+    row = (await db.execute("select * from datasette_secrets")).first()
+    assert row["encryption_key_name"] == "new"
+    assert Fernet(TEST_ENCRYPTION_KEY).decrypt(row["encrypted"]) == b"one"
+    # A row encrypted with the old key is decrypted using that key
+    await db.execute_write(
+        "update datasette_secrets set encrypted = ?, encryption_key_name = 'old'",
+        (Fernet(old_key).encrypt(b"legacy"),),
+    )
+    invalidate_secret_cache(ds)
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "legacy"
+
+
+def test_keyring():
+    other_key = Fernet.generate_key()
+    keyring = KeyRing({"a": TEST_ENCRYPTION_KEY, "b": other_key}, "b")
+    key_name, token = keyring.encrypt("hello")
+    assert key_name == "b"
+    assert keyring.decrypt(token, "b") == "hello"
+    # Unknown key names fall back to trying every key
+    assert keyring.decrypt(token, "renamed") == "hello"
+    with pytest.raises(KeyError):
+        KeyRing({"a": TEST_ENCRYPTION_KEY}, "missing")
+
+
+NEW_ENCRYPTION_KEY = "kWVjhRqQ6F1UO7vHkP8rcCmBNYGDq2ToXNnyV4pZ3nk="
+
+
+def rotation_datasette(internal, current):
+    return Datasette(
+        internal=str(internal),
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-keys": {
+                    "default": TEST_ENCRYPTION_KEY,
+                    "new": NEW_ENCRYPTION_KEY,
+                },
+                "encryption-key-name": current,
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+
+
+@pytest.mark.asyncio
+async def test_rotate_encryption_key_resumes(tmp_path, register_multiple_secrets):
+    internal = tmp_path / "internal.db"
+    ds = rotation_datasette(internal, "default")
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await set_secret(ds, "OPENAI_API_KEY", "two")
+    await set_secret(ds, "OPENAI_API_KEY", "three")
+
+    ds2 = rotation_datasette(internal, "new")
+    await ds2.invoke_startup()
+
+    def crash(last_id, rotated):
+        raise RuntimeError("crash")
+
+    with pytest.raises(RuntimeError):
+        await rotate_encryption_key(ds2, batch_size=2, on_batch=crash)
+    db = get_internal_database(ds2)
+    progress = (await db.execute("select * from datasette_secrets_rotations")).first()
+    assert progress["last_id"] == 2
+    assert progress["rotated"] == 2
+    assert progress["completed_at"] is None
+
+    # Running again picks up where it left off
+    batches = []
+    assert (
+        await rotate_encryption_key(
+            ds2, batch_size=2, on_batch=lambda *args: batches.append(args)
+        )
+        == 3
+    )
+    assert batches == [(3, 3)]
+    rows = (await db.execute("select * from datasette_secrets")).rows
+    assert {row["encryption_key_name"] for row in rows} == {"new"}
+    assert [Fernet(NEW_ENCRYPTION_KEY).decrypt(row["encrypted"]) for row in rows] == [
+        b"one",
+        b"two",
+        b"three",
+    ]
+    assert await get_secret(ds2, "OPENAI_API_KEY") == "three"
+
+
+@pytest.mark.asyncio
+async def test_rotate_encryption_key_superseded(tmp_path, register_multiple_secrets):
+    internal = tmp_path / "internal.db"
+    ds = rotation_datasette(internal, "default")
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await set_secret(ds, "OPENAI_API_KEY", "two")
+    await set_secret(ds, "OPENAI_API_KEY", "three")
+    third_key = Fernet.generate_key().decode("utf-8")
+    ds2 = Datasette(
+        internal=str(internal),
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-keys": {
+                    "default": TEST_ENCRYPTION_KEY,
+                    "new": NEW_ENCRYPTION_KEY,
+                    "third": third_key,
+                },
+            }
+        },
+    )
+    await ds2.invoke_startup()
+
+    def crash(last_id, rotated):
+        raise RuntimeError("crash")
+
+    # Interrupted rotation to new, then a full rotation to third
+    with pytest.raises(RuntimeError):
+        await rotate_encryption_key(ds2, "new", batch_size=1, on_batch=crash)
+    assert await rotate_encryption_key(ds2, "third") == 3
+    # Rotating to new again must start from the beginning, not resume
+    assert await rotate_encryption_key(ds2, "new", batch_size=1) == 3
+    db = get_internal_database(ds2)
+    rows = (await db.execute("select * from datasette_secrets")).rows
+    assert [row["encryption_key_name"] for row in rows] == ["new", "new", "new"]
+    rotations = (
+        await db.execute(
+            "select encryption_key_name, completed_at is not null as completed, "
+            "superseded_at is not null as superseded "
+            "from datasette_secrets_rotations order by id"
+        )
+    ).rows
+    assert [tuple(row) for row in rotations] == [
+        ("new", 0, 1),
+        ("third", 1, 0),
+        ("new", 1, 0),
+    ]
+
+
+def test_rotate_key_command(tmp_path):
+    internal = tmp_path / "internal.db"
+    ds = rotation_datasette(internal, "default")
+    asyncio.run(set_secret(ds, "EXAMPLE_SECRET", "one"))
+    config = tmp_path / "datasette.json"
+    config.write_text(
+        json.dumps(
+            {
+                "plugins": {
+                    "datasette-secrets": {
+                        "encryption-keys": {
+                            "default": TEST_ENCRYPTION_KEY,
+                            "new": NEW_ENCRYPTION_KEY,
+                        },
+                    }
+                }
+            }
+        )
+    )
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "secrets",
+            "rotate-key",
+            "--internal",
+            str(internal),
+            "-c",
+            str(config),
+            "--key-name",
+            "new",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == (
+        "Rotated 1 rows, up to id 1\n" "Re-encrypted 1 secret version using key new\n"
+    )
+    conn = sqlite3.connect(internal)
+    assert conn.execute(
+        "select encryption_key_name from datasette_secrets"
+    ).fetchall() == [("new",)]
+    # Unknown key names are an error
+    result = runner.invoke(
+        cli,
+        [
+            "secrets",
+            "rotate-key",
+            "--internal",
+            str(internal),
+            "-c",
+            str(config),
+            "--key-name",
+            "nope",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "Unknown encryption key: nope" in result.output
+
+
+@pytest.mark.asyncio
+async def test_migrations(ds):
+    await ds.invoke_startup()
+    db = get_internal_database(ds)
+    assert await db.execute_fn(schema_version) == len(MIGRATIONS)
+    applied = [
+        row["name"]
+        for row in await db.execute("select name from datasette_secrets_migrations")
+    ]
+    assert applied == [fn.__name__ for fn in MIGRATIONS]
+    # Running them again does nothing
+    assert await db.execute_write_fn(apply_migrations, transaction=False) == []
+    # Latest version lookups use the (name, version) index
+    plan = await db.execute(
+        "explain query plan select * from datasette_secrets "
+        "where name = ? order by version desc limit 1",
+        ["EXAMPLE_SECRET"],
+    )
+    assert "datasette_secrets_name_version" in " ".join(row["detail"] for row in plan)
+
+
+def test_migrations_concurrent(tmp_path):
+    # Processes starting together against a fresh shared database
+    path = tmp_path / "shared.db"
+    barrier = threading.Barrier(4)
+    results = []
+
+    def start():
+        conn = sqlite3.connect(path, timeout=10)
+        barrier.wait()
+        try:
+            results.append(apply_migrations(conn))
+        except Exception as ex:
+            results.append(ex)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=start) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [r for r in results if isinstance(r, Exception)] == []
+    assert sorted(results, key=len) == [[], [], [], [fn.__name__ for fn in MIGRATIONS]]
+
+
+@pytest.mark.asyncio
+async def test_current_version_pointer(ds):
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await set_secret(ds, "EXAMPLE_SECRET", "two")
+    db = get_internal_database(ds)
+    current = [
+        dict(row)
+        for row in await db.execute(
+            "select name, secret_id from datasette_secrets_current"
+        )
+    ]
+    assert current == [{"name": "EXAMPLE_SECRET", "secret_id": 2}]
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "two"
+
+
+def test_current_version_migration_backfills():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(SCHEMA)
+    conn.executemany(
+        """
+        insert into datasette_secrets (name, version, encryption_key_name)
+        values (?, ?, 'default')
+        """,
+        [("A", 1), ("A", 2), ("B", 1), ("A", 3)],
+    )
+    conn.commit()
+    apply_migrations(conn)
+    assert conn.execute(
+        "select name, secret_id from datasette_secrets_current order by name"
+    ).fetchall() == [("A", 4), ("B", 3)]
+
+
+@pytest.mark.asyncio
+async def test_metrics(ds, monkeypatch):
+    timings = []
+
+    class TimingPlugin:
+        __name__ = "TimingPlugin"
+
+        @hookimpl
+        def secrets_timing(self, phase, duration, secret_names):
+            timings.append((phase, secret_names))
+
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    pm.register(TimingPlugin(), name="TimingPlugin")
+    try:
+        assert await get_secret(ds, "EXAMPLE_SECRET") == "one"
+        assert await get_secret(ds, "EXAMPLE_SECRET") == "one"
+    finally:
+        pm.unregister(name="TimingPlugin")
+    assert ("db_fetch", ["EXAMPLE_SECRET"]) in timings
+    assert ("decrypt", ["EXAMPLE_SECRET"]) in timings
+
+    # Permission is required to see the metrics
+    response = await ds.client.get("/-/secrets/metrics.json")
+    assert response.status_code == 403
+    response = await ds.client.get(
+        "/-/secrets/metrics.json",
+        cookies={"ds_actor": actor_cookie(ds, {"id": "admin"})},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["counters"] == {"lookups": 2, "cache_hits": 1, "cache_misses": 1}
+    assert data["reads"] == {"EXAMPLE_SECRET": 2}
+    assert data["timings"]["registry"]["count"] == 2
+    assert data["timings"]["db_fetch"]["count"] == 1
+    assert sum(data["timings"]["usage_write"]["buckets"].values()) == 2
+
+
+@pytest.mark.asyncio
+async def test_environment_snapshot(ds, monkeypatch):
+    monkeypatch.setenv("DATASETTE_SECRETS_EXAMPLE_SECRET", "first")
+    monkeypatch.setenv("DATASETTE_SECRETS_EMPTY", "")
+    await ds.invoke_startup()
+    environment = get_environment_secrets(ds)
+    assert environment["EXAMPLE_SECRET"] == "first"
+    assert "EMPTY" not in environment
+    with pytest.raises(TypeError):
+        environment["EXAMPLE_SECRET"] = "nope"
+    # Changes are not seen until the snapshot is reloaded
+    monkeypatch.setenv("DATASETTE_SECRETS_EXAMPLE_SECRET", "second")
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "first"
+    assert reload_environment_secrets(ds) == {"EXAMPLE_SECRET"}
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "second"
+    assert reload_environment_secrets(ds) == set()
+
+
+@pytest.mark.asyncio
+async def test_secrets_json(
+    ds, register_multiple_secrets, monkeypatch, use_actors_plugin
+):
+    await set_secret(ds, "OPENAI_API_KEY", "one", note="a note")
+    await set_secret(ds, "EXAMPLE_SECRET", "two")
+    monkeypatch.setenv("DATASETTE_SECRETS_OPENCAGE_API_KEY", "from env")
+    reload_environment_secrets(ds)
+    cookies = {"ds_actor": actor_cookie(ds, {"id": "admin"})}
+
+    async def fetch(qs):
+        response = await ds.client.get("/-/secrets.json?" + qs, cookies=cookies)
+        return response.json()
+
+    page1 = await fetch("_size=2")
+    assert [(s["name"], s["state"]) for s in page1["secrets"]] == [
+        ("EXAMPLE_SECRET", "set"),
+        ("OPENAI_API_KEY", "set"),
+    ]
+    openai = page1["secrets"][1]
+    assert openai["version"] == 1
+    assert openai["note"] == "a note"
+    assert openai["updated_by"] == "admin"
+    assert openai["obtain_label"] == "Get an OpenAI API key"
+    assert page1["next"] == "set:OPENAI_API_KEY"
+    assert page1["next_url"] == "/-/secrets.json?_size=2&_next=set%3AOPENAI_API_KEY"
+    page2 = await fetch("_size=2&_next=set:OPENAI_API_KEY")
+    assert [(s["name"], s["state"]) for s in page2["secrets"]] == [
+        ("ANTHROPIC_API_KEY", "unset"),
+        ("OPENCAGE_API_KEY", "environment"),
+    ]
+    assert page2["next"] is None
+    # Filters
+    by_prefix = await fetch("prefix=OPEN")
+    assert [(s["name"], s["state"]) for s in by_prefix["secrets"]] == [
+        ("OPENAI_API_KEY", "set"),
+        ("OPENCAGE_API_KEY", "environment"),
+    ]
+    unset = await fetch("state=unset")
+    assert [s["name"] for s in unset["secrets"]] == ["ANTHROPIC_API_KEY"]
+    bad = await ds.client.get("/-/secrets.json?state=nope", cookies=cookies)
+    assert bad.status_code == 400
+    assert bad.json()["ok"] is False
+    assert (await ds.client.get("/-/secrets.json")).status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_secret_index_page_pagination(ds, register_multiple_secrets):
+    cookies = {"ds_actor": actor_cookie(ds, {"id": "admin"})}
+    response = await ds.client.get("/-/secrets?_size=3", cookies=cookies)
+    assert "OPENCAGE_API_KEY" in response.text
+    assert "EXAMPLE_SECRET" not in response.text
+    assert (
+        '<a href="/-/secrets?_size=3&amp;_next=unset%3AOPENCAGE_API_KEY">Next page</a>'
+        in response.text
+    )
+    response2 = await ds.client.get(
+        "/-/secrets?_size=3&_next=unset%3AOPENCAGE_API_KEY", cookies=cookies
+    )
+    assert "EXAMPLE_SECRET" in response2.text
+    assert "OPENCAGE_API_KEY" not in response2.text
+    assert "Next page" not in response2.text
+    # A cursor for a secret that is no longer registered is rejected, rather
+    # than silently restarting from the first page
+    stale = await ds.client.get(
+        "/-/secrets.json?_next=unset%3AREMOVED_SECRET", cookies=cookies
+    )
+    assert stale.status_code == 400
+    assert stale.json() == {
+        "ok": False,
+        "error": "Stale cursor: REMOVED_SECRET is no longer registered",
+    }
+
+
+async def versions(ds):
+    db = get_internal_database(ds)
+    return [
+        (row["name"], row["version"])
+        for row in await db.execute(
+            "select name, version from datasette_secrets order by id"
+        )
+    ]
+
+
+@pytest.mark.asyncio
+async def test_compact_secrets(ds, register_multiple_secrets):
+    for value in ("one", "two", "three", "four"):
+        await set_secret(ds, "EXAMPLE_SECRET", value)
+    await set_secret(ds, "OPENAI_API_KEY", "only")
+    # No policy configured, nothing happens
+    assert await compact_secrets(ds) == 0
+    batches = []
+    assert (
+        await compact_secrets(
+            ds, keep_versions=2, batch_size=1, on_batch=batches.append
+        )
+        == 2
+    )
+    assert batches == [1, 2]
+    assert await versions(ds) == [
+        ("EXAMPLE_SECRET", 3),
+        ("EXAMPLE_SECRET", 4),
+        ("OPENAI_API_KEY", 1),
+    ]
+    # Age based: the current version is always kept
+    db = get_internal_database(ds)
+    await db.execute_write(
+        "update datasette_secrets set created_at = datetime('now', '-40 days')"
+    )
+    assert await compact_secrets(ds, keep_days=30) == 1
+    assert await versions(ds) == [("EXAMPLE_SECRET", 4), ("OPENAI_API_KEY", 1)]
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "four"
+
+
+@pytest.mark.asyncio
+async def test_compaction_runs_in_background():
+    ds = Datasette(
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-key": TEST_ENCRYPTION_KEY,
+                "keep-versions": 1,
+                "compact-interval": 0.01,
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await set_secret(ds, "EXAMPLE_SECRET", "two")
+    for _ in range(100):
+        if await versions(ds) == [("EXAMPLE_SECRET", 2)]:
+            break
+        await asyncio.sleep(0.01)
+    assert await versions(ds) == [("EXAMPLE_SECRET", 2)]
+    ds._secrets_compaction_task.cancel()
+
+
+def test_compact_command(tmp_path):
+    internal = tmp_path / "internal.db"
+    ds = rotation_datasette(internal, "default")
+
+    async def setup():
+        for value in ("one", "two", "three"):
+            await set_secret(ds, "EXAMPLE_SECRET", value)
+
+    asyncio.run(setup())
+    config = tmp_path / "datasette.json"
+    config.write_text(
+        json.dumps(
+            {"plugins": {"datasette-secrets": {"encryption-key": TEST_ENCRYPTION_KEY}}}
+        )
+    )
+    runner = CliRunner()
+    args = ["secrets", "compact", "--internal", str(internal), "-c", str(config)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "No retention policy" in result.output
+    result = runner.invoke(cli, args + ["--keep-versions", "1"])
+    assert result.exit_code == 0, result.output
+    assert result.output == "Deleted 2 old secret versions\n"
+    conn = sqlite3.connect(internal)
+    assert conn.execute("select version from datasette_secrets").fetchall() == [(3,)]
+
+
+def test_import_export_commands(tmp_path):
+    internal = tmp_path / "internal.db"
+    config = tmp_path / "datasette.json"
+    config.write_text(
+        json.dumps(
+            {"plugins": {"datasette-secrets": {"encryption-key": TEST_ENCRYPTION_KEY}}}
+        )
+    )
+    options = ["--internal", str(internal), "-c", str(config)]
+    jsonl = tmp_path / "secrets.jsonl"
+    jsonl.write_text(
+        json.dumps({"name": "ONE", "secret": "1", "note": "first"})
+        + "\n"
+        + json.dumps({"name": "TWO", "secret": "2"})
+        + "\n"
+        + json.dumps({"name": "ONE", "secret": "1b"})
+        + "\n"
+    )
+    dotenv = tmp_path / "more.env"
+    dotenv.write_text(
+        "# Comment\n"
+        "export DATASETTE_SECRETS_THREE=3\n"
+        'FOUR="has spaces and \\"quotes\\""\n'
+        'FIVE="C:\\path"\n'
+    )
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["secrets", "import", str(jsonl)]
+        + options
+        + ["--batch-size", "2", "--actor", "bob"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Imported 3 secrets" in result.output
+    result = runner.invoke(cli, ["secrets", "import", str(dotenv)] + options)
+    assert result.exit_code == 0, result.output
+    conn = sqlite3.connect(internal)
+    assert conn.execute(
+        "select name, version, created_by from datasette_secrets order by id"
+    ).fetchall() == [
+        ("ONE", 1, "bob"),
+        ("TWO", 1, "bob"),
+        ("ONE", 2, "bob"),
+        ("THREE", 1, None),
+        ("FOUR", 1, None),
+        ("FIVE", 1, None),
+    ]
+
+    # Export encrypted tokens
+    result = runner.invoke(cli, ["secrets", "export"] + options)
+    assert result.exit_code == 0, result.output
+    records = [json.loads(line) for line in result.output.splitlines()]
+    assert [(r["name"], r["version"]) for r in records] == [
+        ("FIVE", 1),
+        ("FOUR", 1),
+        ("ONE", 2),
+        ("THREE", 1),
+        ("TWO", 1),
+    ]
+    assert "secret" not in records[0]
+    assert Fernet(TEST_ENCRYPTION_KEY).decrypt(records[2]["encrypted"]) == b"1b"
+
+    # Plaintext .env export round-trips through import
+    result = runner.invoke(cli, ["secrets", "export", "--format", "env"] + options)
+    assert result.exit_code == 1
+    assert "--format env requires --plaintext" in result.output
+    result = runner.invoke(
+        cli, ["secrets", "export", "--format", "env", "--plaintext"] + options
+    )
+    assert result.output == (
+        'FIVE="C:\\\\path"\n'
+        'FOUR="has spaces and \\"quotes\\""\n'
+        "ONE=1b\n"
+        "THREE=3\n"
+        "TWO=2\n"
+    )
+    assert list(read_env(result.output.splitlines()))[:2] == [
+        {"name": "FIVE", "secret": "C:\\path"},
+        {"name": "FOUR", "secret": 'has spaces and "quotes"'},
+    ]
+
+    # Invalid input is reported
+    bad = tmp_path / "bad.jsonl"
+    bad.write_text('{"name": "X"}\n')
+    result = runner.invoke(cli, ["secrets", "import", str(bad)] + options)
+    assert result.exit_code == 1
+    assert "Line 1: missing secret" in result.output
+    # Nothing is imported from a file with an invalid line
+    bad.write_text('{"name": "SIX", "secret": "6"}\n{"name": "X"}\n')
+    result = runner.invoke(
+        cli, ["secrets", "import", str(bad), "--batch-size", "1"] + options
+    )
+    assert result.exit_code == 1
+    assert "Line 2: missing secret" in result.output
+    assert conn.execute(
+        "select count(*) from datasette_secrets where name = 'SIX'"
+    ).fetchone() == (0,)
+
+
+def file_store_datasette(path, **extra_config):
+    return Datasette(
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-key": TEST_ENCRYPTION_KEY,
+                "store": "file",
+                "store-file": str(path),
+                **extra_config,
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+
+
+@pytest.mark.asyncio
+async def test_file_store(tmp_path, register_multiple_secrets):
+    path = tmp_path / "secrets.json"
+    ds = file_store_datasette(path)
+    await ds.invoke_startup()
+    assert isinstance(get_store(ds), FileSecretStore)
+    await set_secret(ds, "OPENAI_API_KEY", "sk-file", note="In a file")
+    await set_secret(ds, "OPENAI_API_KEY", "sk-file-2", note="In a file")
+    assert await get_secret(ds, "OPENAI_API_KEY") == "sk-file-2"
+    # Stored encrypted, current version only
+    data = json.loads(path.read_text())
+    assert "sk-file" not in path.read_text()
+    stored = data["secrets"]["OPENAI_API_KEY"]
+    assert stored["version"] == 2
+    assert stored["note"] == "In a file"
+    assert stored["updated_by"] == "admin"
+    assert Fernet(TEST_ENCRYPTION_KEY).decrypt(stored["encrypted"]) == b"sk-file-2"
+    # Nothing was written to the internal database
+    internal_tables = await ds.get_internal_database().table_names()
+    assert "datasette_secrets" not in internal_tables
+    # A new instance loads the file at startup
+    ds2 = file_store_datasette(path)
+    await ds2.invoke_startup()
+    assert await get_secret(ds2, "OPENAI_API_KEY") == "sk-file-2"
+    data = (
+        await ds2.client.get(
+            "/-/secrets.json?state=set",
+            cookies={"ds_actor": actor_cookie(ds2, {"id": "admin"})},
+        )
+    ).json()
+    assert [item["name"] for item in data["secrets"]] == ["OPENAI_API_KEY"]
+
+
+def test_file_store_concurrent_writers(tmp_path):
+    # Separate store instances stand in for separate processes
+    path = tmp_path / "secrets.json"
+    barrier = threading.Barrier(3)
+    errors = []
+
+    def writer(number):
+        store = FileSecretStore(None, {"store-file": str(path)})
+
+        async def write():
+            await store.startup()
+            barrier.wait()
+            for i in range(30):
+                await store.put_many(
+                    [
+                        {
+                            "name": "SECRET_{}_{}".format(number, i),
+                            "encrypted": b"token",
+                            "encryption_key_name": "default",
+                            "note": None,
+                            "actor_id": None,
+                        }
+                    ]
+                )
+
+        try:
+            asyncio.run(write())
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(json.loads(path.read_text())["secrets"]) == 90
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == ".tmp"] == []
+
+
+@pytest.mark.asyncio
+async def test_register_secret_stores(register_multiple_secrets):
+    class MemoryStore(SecretStore):
+        name = "memory"
+
+        def __init__(self, datasette, plugin_config):
+            super().__init__(datasette, plugin_config)
+            self.secrets = {}
+
+        async def get_many(self, names):
+            return {name: self.secrets[name] for name in names if name in self.secrets}
+
+        async def put_many(self, versions):
+            for version in versions:
+                self.secrets[version["name"]] = StoredSecret(
+                    name=version["name"],
+                    version=1,
+                    encrypted=version["encrypted"],
+                    encryption_key_name=version["encryption_key_name"],
+                    note=version["note"],
+                )
+
+    class MemoryStorePlugin:
+        __name__ = "MemoryStorePlugin"
+
+        @hookimpl
+        def register_secret_stores(self):
+            return [MemoryStore]
+
+    pm.register(MemoryStorePlugin(), name="MemoryStorePlugin")
+    try:
+        ds = Datasette(
+            plugin_config={
+                "datasette-secrets": {
+                    "encryption-key": TEST_ENCRYPTION_KEY,
+                    "store": "memory",
+                }
+            },
+            permissions={"manage-secrets": {"id": "admin"}},
+        )
+        await ds.invoke_startup()
+        await set_secret(ds, "OPENCAGE_API_KEY", "in-memory")
+        assert await get_secret(ds, "OPENCAGE_API_KEY") == "in-memory"
+        assert set(get_store(ds).secrets) == {"OPENCAGE_API_KEY"}
+        with pytest.raises(ValueError):
+            await compact_secrets(ds, keep_versions=1)
+    finally:
+        pm.unregister(name="MemoryStorePlugin")
+
+    unknown = Datasette(
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-key": TEST_ENCRYPTION_KEY,
+                "store": "missing",
+            }
+        },
+    )
+    with pytest.raises(ValueError):
+        get_store(unknown)
+
+
+@pytest.mark.asyncio
+async def test_warm_cache(tmp_path, register_multiple_secrets, monkeypatch, capsys):
+    internal = tmp_path / "internal.db"
+    monkeypatch.setenv("DATASETTE_SECRETS_OPENCAGE_API_KEY", "from-env")
+    ds = rotation_datasette(internal, "default")
+    await ds.invoke_startup()
+    await set_secret(ds, "OPENAI_API_KEY", "sk-warm")
+    await set_secret(ds, "ANTHROPIC_API_KEY", "sk-ant")
+
+    # Warm-up stops once the cache is full
+    ds4 = Datasette(
+        internal=str(internal),
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-keys": {
+                    "default": TEST_ENCRYPTION_KEY,
+                    "new": NEW_ENCRYPTION_KEY,
+                },
+                "warm-cache": True,
+                "cache-size": 1,
+            }
+        },
+    )
+    await ds4.invoke_startup()
+    assert "skipped 2 that did not fit in cache-size" in capsys.readouterr().err
+    warm_up = ds4._secrets_metrics.warm_up
+    assert (warm_up["secrets"], warm_up["skipped"]) == (1, 2)
+    assert len(ds4._secrets_cache) == 1
+
+    ds2 = Datasette(
+        internal=str(internal),
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-keys": {
+                    "default": TEST_ENCRYPTION_KEY,
+                    "new": NEW_ENCRYPTION_KEY,
+                },
+                "warm-cache": True,
+            }
+        },
+    )
+    await ds2.invoke_startup()
+    assert "warmed cache with 2 secrets" in capsys.readouterr().err
+    assert ds2._secrets_metrics.warm_up["secrets"] == 2
+    cache = ds2._secrets_cache
+    assert len(cache) == 2
+    assert "OPENAI_API_KEY" in cache and "ANTHROPIC_API_KEY" in cache
+    # Served from the cache, without a database query
+    await get_internal_database(ds2).execute_write("drop table datasette_secrets")
+    assert await get_secret(ds2, "OPENAI_API_KEY") == "sk-warm"
+    assert ds2._secrets_metrics.counters["cache_hits"] == 1
+
+    # There is nothing to warm if the cache is disabled
+    ds3 = Datasette(
+        plugin_config={
+            "datasette-secrets": {"encryption-key": TEST_ENCRYPTION_KEY, "cache": False}
+        }
+    )
+    assert await warm_secret_cache(ds3) is None
+
+
+@pytest.mark.asyncio
+async def test_cross_process_change_detection(tmp_path, register_multiple_secrets):
+    internal = tmp_path / "internal.db"
+
+    def worker(interval):
+        return Datasette(
+            internal=str(internal),
+            plugin_config={
+                "datasette-secrets": {
+                    "encryption-key": TEST_ENCRYPTION_KEY,
+                    "change-check-interval": interval,
+                }
+            },
+            permissions={"manage-secrets": {"id": "admin"}},
+        )
+
+    one, two, slow = worker(0), worker(0), worker(3600)
+    for ds in (one, two, slow):
+        await ds.invoke_startup()
+    await set_secret(one, "OPENAI_API_KEY", "first")
+    for ds in (one, two, slow):
+        assert await get_secret(ds, "OPENAI_API_KEY") == "first"
+
+    # Unchanged generation means the cache is used
+    assert not await revalidate_secret_cache(two)
+    assert await get_secret(two, "OPENAI_API_KEY") == "first"
+    assert two._secrets_metrics.counters["cache_hits"] == 1
+
+    # A write by one worker is seen by the others on their next check
+    await set_secret(one, "OPENAI_API_KEY", "second")
+    assert await get_secret(two, "OPENAI_API_KEY") == "second"
+    assert two._secrets_metrics.counters["cache_invalidations"] == 1
+    assert await get_secret(slow, "OPENAI_API_KEY") == "first"
+    assert await revalidate_secret_cache(slow, force=True)
+    assert await get_secret(slow, "OPENAI_API_KEY") == "second"
+
+
+@pytest.mark.asyncio
+async def test_file_store_change_detection(tmp_path, register_multiple_secrets):
+    path = tmp_path / "secrets.json"
+    one, two = file_store_datasette(path), file_store_datasette(path)
+    for ds in (one, two):
+        await ds.invoke_startup()
+    await set_secret(one, "OPENAI_API_KEY", "first")
+    assert await revalidate_secret_cache(two, force=True) is False
+    assert await get_secret(two, "OPENAI_API_KEY") == "first"
+    await set_secret(one, "OPENAI_API_KEY", "second")
+    assert await revalidate_secret_cache(two, force=True)
+    assert await get_secret(two, "OPENAI_API_KEY") == "second"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_are_coalesced(ds, monkeypatch):
+    await ds.invoke_startup()
+    await set_secret(ds, "EXAMPLE_SECRET", "shared")
+    store = get_store(ds)
+    original_get_many = store.get_many
+    calls = []
+
+    async def slow_get_many(names):
+        calls.append(list(names))
+        await asyncio.sleep(0.01)
+        return await original_get_many(names)
+
+    monkeypatch.setattr(store, "get_many", slow_get_many)
+    results = await asyncio.gather(
+        *[get_secret(ds, "EXAMPLE_SECRET", "actor{}".format(i)) for i in range(10)]
+    )
+    assert results == ["shared"] * 10
+    assert calls == [["EXAMPLE_SECRET"]]
+    metrics = ds._secrets_metrics
+    assert metrics.counters["coalesced"] == 9
+    # Every caller's read is still counted and its usage recorded
+    assert metrics.reads["EXAMPLE_SECRET"] == 10
+    await flush_usage(ds)
+    row = (
+        await get_internal_database(ds).execute(
+            "select last_used_by from datasette_secrets"
+        )
+    ).first()
+    assert row["last_used_by"].startswith("actor")
+    assert ds._secrets_inflight == {}
+
+    # Cancelling the caller that started the fetch does not affect the others
+    invalidate_secret_cache(ds)
+    calls.clear()
+    first = asyncio.ensure_future(get_secret(ds, "EXAMPLE_SECRET"))
+    while not calls:
+        await asyncio.sleep(0)
+    second = asyncio.ensure_future(get_secret(ds, "EXAMPLE_SECRET"))
+    while ds._secrets_metrics.counters["coalesced"] < 10:
+        await asyncio.sleep(0)
+    first.cancel()
+    assert await second == "shared"
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    assert calls == [["EXAMPLE_SECRET"]]
+    assert ds._secrets_inflight == {}
+
+    # A fetch that read the old value is not shared with, or cached for, callers
+    # that arrive after a write
+    invalidate_secret_cache(ds)
+    read = asyncio.Event()
+    release = asyncio.Event()
+
+    async def stale_get_many(names):
+        stored = await original_get_many(names)
+        read.set()
+        await release.wait()
+        return stored
+
+    monkeypatch.setattr(store, "get_many", stale_get_many)
+    waiting = asyncio.ensure_future(get_secret(ds, "EXAMPLE_SECRET"))
+    await read.wait()
+    monkeypatch.setattr(store, "get_many", original_get_many)
+    await set_secret(ds, "EXAMPLE_SECRET", "new")
+    later = asyncio.ensure_future(get_secret(ds, "EXAMPLE_SECRET"))
+    release.set()
+    assert await waiting == "shared"
+    assert await later == "new"
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "new"
+    assert ds._secrets_inflight == {}
+
+    # Errors are passed to every waiting caller
+    async def broken_get_many(names):
+        await asyncio.sleep(0.01)
+        raise ValueError("broken")
+
+    invalidate_secret_cache(ds)
+    monkeypatch.setattr(store, "get_many", broken_get_many)
+    results = await asyncio.gather(
+        get_secret(ds, "EXAMPLE_SECRET"),
+        get_secret(ds, "EXAMPLE_SECRET"),
+        return_exceptions=True,
+    )
+    assert [str(result) for result in results] == ["broken", "broken"]
+    assert ds._secrets_inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_actor_display_names_are_cached(ds):
+    looked_up = []
+
+    class ActorPlugin:
+        __name__ = "CountingActorPlugin"
+
+        @hookimpl
+        def actors_from_ids(self, actor_ids):
+            looked_up.append(sorted(actor_ids))
+            return {id: {"id": id, "name": id.title()} for id in actor_ids}
+
+    pm.register(ActorPlugin(), name="CountingActorPlugin")
+    try:
+        await ds.invoke_startup()
+        await set_secret(ds, "EXAMPLE_SECRET", "one")
+        cookies = {"ds_actor": actor_cookie(ds, {"id": "admin"})}
+        response = await ds.client.get("/-/secrets", cookies=cookies)
+        assert "<td>Admin</td>" in response.text
+        data = (await ds.client.get("/-/secrets.json", cookies=cookies)).json()
+        assert data["secrets"][0]["updated_by_display"] == "Admin"
+        response = await ds.client.get("/-/secrets/EXAMPLE_SECRET", cookies=cookies)
+        assert "by Admin" in response.text
+        # One lookup shared by all three views
+        assert looked_up == [["admin"]]
+        # Only uncached IDs are looked up
+        assert await get_actor_display_names(ds, ["admin", "bob"]) == {
+            "admin": "Admin",
+            "bob": "Bob",
+        }
+        assert looked_up == [["admin"], ["bob"]]
+    finally:
+        pm.unregister(name="CountingActorPlugin")
+
+
+@pytest.mark.asyncio
+async def test_permission_checks_are_cached(ds, monkeypatch):
+    await ds.invoke_startup()
+    checks = []
+    original_allowed = ds.allowed
+
+    async def counting_allowed(*args, **kwargs):
+        if kwargs.get("action") == "manage-secrets":
+            checks.append(kwargs.get("actor"))
+        return await original_allowed(*args, **kwargs)
+
+    monkeypatch.setattr(ds, "allowed", counting_allowed)
+    admin = {"ds_actor": actor_cookie(ds, {"id": "admin"})}
+    other = {"ds_actor": actor_cookie(ds, {"id": "other"})}
+    # menu_links, the index and the update page share the same check
+    response = await ds.client.get("/", cookies=admin)
+    assert "Manage secrets" in response.text
+    assert (await ds.client.get("/-/secrets", cookies=admin)).status_code == 200
+    response = await ds.client.get("/-/secrets/EXAMPLE_SECRET", cookies=admin)
+    assert response.status_code == 200
+    assert (await ds.client.get("/-/secrets", cookies=other)).status_code == 403
+    assert (await ds.client.get("/-/secrets", cookies=other)).status_code == 403
+    assert checks == [{"id": "admin"}, {"id": "other"}]
+
+    # Replacing the permissions configuration clears the cache
+    ds.config = dict(ds.config, permissions={"manage-secrets": {"id": "other"}})
+    assert (await ds.client.get("/-/secrets", cookies=other)).status_code == 200
+    assert (await ds.client.get("/-/secrets", cookies=admin)).status_code == 403
+
+    # As does invalidate_permission_cache()
+    ds.config["permissions"]["manage-secrets"]["id"] = "admin"
+    assert (await ds.client.get("/-/secrets", cookies=admin)).status_code == 403
+    invalidate_permission_cache(ds)
+    assert (await ds.client.get("/-/secrets", cookies=admin)).status_code == 200
+
+
+def test_cryptography_is_imported_lazily():
+    code = (
+        "import sys, asyncio\n"
+        "from datasette.app import Datasette\n"
+        "ds = Datasette(config={'plugins': {'datasette-secrets': "
+        "{'encryption-key': %r}}})\n"
+        "asyncio.run(ds.invoke_startup())\n"
+        "assert 'cryptography.fernet' not in sys.modules\n"
+        "from datasette_secrets import get_keyring\n"
+        "get_keyring(ds).encrypt('x')\n"
+        "assert 'cryptography.fernet' in sys.modules\n"
+    ) % TEST_ENCRYPTION_KEY
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+@pytest.mark.asyncio
+async def test_dedicated_database_file(tmp_path, register_multiple_secrets):
+    path = tmp_path / "secrets.db"
+    ds = Datasette(
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-key": TEST_ENCRYPTION_KEY,
+                "database-file": str(path),
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+    await ds.invoke_startup()
+    await set_secret(ds, "OPENAI_API_KEY", "dedicated")
+    assert await get_secret(ds, "OPENAI_API_KEY") == "dedicated"
+    # Stored in the dedicated file, which is not in the internal database
+    internal_tables = await ds.get_internal_database().table_names()
+    assert "datasette_secrets" not in internal_tables
+    conn = sqlite3.connect(str(path))
+    assert conn.execute("pragma journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("pragma auto_vacuum").fetchone()[0] == 2
+    assert [row[0] for row in conn.execute("select name from datasette_secrets")] == [
+        "OPENAI_API_KEY"
+    ]
+    conn.close()
+    # And it is hidden from users
+    assert "_secrets" not in ds.databases
+    response = await ds.client.get(
+        "/_secrets.json", cookies={"ds_actor": actor_cookie(ds, {"id": "root"})}
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_register_secrets_resolved_concurrently(capsys):
+    class SlowPlugin:
+        __name__ = "SlowPlugin"
+
+        def __init__(self, delay, names):
+            self.delay = delay
+            self.names = names
+
+        @hookimpl
+        def register_secrets(self, datasette):
+            async def inner():
+                await asyncio.sleep(self.delay)
+                return [Secret(name) for name in self.names]
+
+            return inner
+
+    plugins = {
+        "SlowOne": SlowPlugin(0.1, ["ONE", "SHARED"]),
+        "SlowTwo": SlowPlugin(0.1, ["SHARED", "TWO"]),
+        "Stuck": SlowPlugin(60, ["STUCK"]),
+    }
+    for name in ("Stuck", "SlowTwo", "SlowOne"):
+        pm.register(plugins[name], name=name)
+    try:
+        ds = Datasette(
+            plugin_config={
+                "datasette-secrets": {
+                    "encryption-key": TEST_ENCRYPTION_KEY,
+                    "register-secrets-timeout": 0.3,
+                }
+            }
+        )
+        start = time.perf_counter()
+        registry = await get_registry(ds)
+        assert time.perf_counter() - start < 0.5
+        # First registered wins, in hook order
+        assert [secret.name for secret in registry] == [
+            "ONE",
+            "SHARED",
+            "TWO",
+            "EXAMPLE_SECRET",
+        ]
+        assert registry.timed_out == ("Stuck",)
+        assert "Stuck register_secrets() timed out" in capsys.readouterr().err
+
+        # The registry is kept until the retry delay has passed
+        assert registry.retry_at > time.monotonic()
+        assert await get_registry(ds) is registry
+        # Then the timed out plugin is retried in the background
+        plugins["Stuck"].delay = 0.5
+        registry.retry_at = 0
+        assert await get_registry(ds) is registry
+        await ds._secrets_registry_retry
+        retried = await get_registry(ds)
+        assert "STUCK" not in retried
+        assert retried.retries == 1
+        assert retried.retry_at - time.monotonic() > 1
+        plugins["Stuck"].delay = 0
+        retried.retry_at = 0
+        await get_registry(ds)
+        await ds._secrets_registry_retry
+        registry = await get_registry(ds)
+        assert registry.timed_out == ()
+        assert [secret.name for secret in registry] == [
+            "ONE",
+            "SHARED",
+            "TWO",
+            "STUCK",
+            "EXAMPLE_SECRET",
+        ]
+    finally:
+        for name in plugins:
+            pm.unregister(name=name)
+
+
+@pytest.mark.asyncio
+async def test_register_secrets_wrappers(register_multiple_secrets):
+    wrapped = []
+
+    class WrapperPlugin:
+        __name__ = "WrapperPlugin"
+
+        @hookimpl(wrapper=True)
+        def register_secrets(self):
+            results = yield
+            wrapped.append(len(results))
+            return results
+
+    class OldStyleWrapperPlugin:
+        __name__ = "OldStyleWrapperPlugin"
+
+        @hookimpl(hookwrapper=True)
+        def register_secrets(self):
+            yield
+
+    pm.register(WrapperPlugin(), name="WrapperPlugin")
+    pm.register(OldStyleWrapperPlugin(), name="OldStyleWrapperPlugin")
+    try:
+        ds = Datasette(
+            plugin_config={"datasette-secrets": {"encryption-key": TEST_ENCRYPTION_KEY}}
+        )
+        registry = await get_registry(ds)
+        assert [secret.name for secret in registry] == [
+            "OPENAI_API_KEY",
+            "ANTHROPIC_API_KEY",
+            "OPENCAGE_API_KEY",
+            "EXAMPLE_SECRET",
+        ]
+        # Wrappers run around each plugin's implementation
+        assert wrapped == [1, 1]
+        assert await get_secret(ds, "OPENAI_API_KEY") is None
+    finally:
+        pm.unregister(name="WrapperPlugin")
+        pm.unregister(name="OldStyleWrapperPlugin")
+
+
+@pytest.mark.asyncio
+async def test_subscribe_to_secret(ds, monkeypatch, capsys):
+    await ds.invoke_startup()
+    seen = []
+    async_seen = []
+
+    async def async_callback(name):
+        async_seen.append((name, await get_secret(ds, name)))
+
+    def broken_callback(name):
+        raise ValueError("broken")
+
+    unsubscribe = subscribe_to_secret(ds, "EXAMPLE_SECRET", seen.append)
+    subscribe_to_secret(ds, "EXAMPLE_SECRET", async_callback)
+    subscribe_to_secret(ds, "EXAMPLE_SECRET", broken_callback)
+    subscribe_to_secret(ds, "OTHER", seen.append)
+
+    # Saving a new version notifies subscribers, after the cache is cleared
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    assert await get_secret(ds, "EXAMPLE_SECRET") == "one"
+    await set_secret(ds, "EXAMPLE_SECRET", "two")
+    for _ in range(100):
+        if len(async_seen) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert seen == ["EXAMPLE_SECRET", "EXAMPLE_SECRET"]
+    assert async_seen == [("EXAMPLE_SECRET", "one"), ("EXAMPLE_SECRET", "two")]
+    assert "subscriber for EXAMPLE_SECRET failed" in capsys.readouterr().err
+
+    # Updating just the note does not
+    await set_secret(ds, "EXAMPLE_SECRET", "", note="A note")
+    assert len(seen) == 2
+
+    # Environment variable changes are reported on reload
+    monkeypatch.setenv("DATASETTE_SECRETS_EXAMPLE_SECRET", "from-env")
+    reload_environment_secrets(ds)
+    assert seen == ["EXAMPLE_SECRET"] * 3
+
+    unsubscribe()
+    monkeypatch.delenv("DATASETTE_SECRETS_EXAMPLE_SECRET")
+    reload_environment_secrets(ds)
+    assert seen == ["EXAMPLE_SECRET"] * 3
+
+
+@pytest.mark.asyncio
+async def test_watch_secret(ds):
+    await ds.invoke_startup()
+    values = []
+
+    async def watch():
+        async for value in watch_secret(ds, "EXAMPLE_SECRET"):
+            values.append(value)
+            if len(values) == 2:
+                break
+
+    task = asyncio.ensure_future(watch())
+    await asyncio.sleep(0)
+    await set_secret(ds, "EXAMPLE_SECRET", "one")
+    await asyncio.sleep(0.01)
+    await set_secret(ds, "EXAMPLE_SECRET", "two")
+    await asyncio.wait_for(task, 1)
+    assert values == ["one", "two"]
+    # The watcher unsubscribed when the loop ended
+    assert "EXAMPLE_SECRET" not in ds._secrets_subscriptions
+
+
+@pytest.mark.asyncio
+async def test_get_secret_sync(tmp_path, register_multiple_secrets, monkeypatch):
+    internal = tmp_path / "internal.db"
+    writer = rotation_datasette(internal, "default")
+    await writer.invoke_startup()
+    await set_secret(writer, "OPENAI_API_KEY", "sk-sync")
+
+    ds = Datasette(
+        internal=str(internal),
+        plugin_config={
+            "datasette-secrets": {
+                "encryption-key": TEST_ENCRYPTION_KEY,
+                "sync-secrets": True,
+            }
+        },
+        permissions={"manage-secrets": {"id": "admin"}},
+    )
+    # Nothing is loaded before startup
+    with pytest.raises(SecretNotLoaded):
+        get_secret_sync(ds, "OPENAI_API_KEY")
+    await ds.invoke_startup()
+    try:
+        assert get_secret_sync(ds, "OPENAI_API_KEY") == "sk-sync"
+        assert get_secret_sync(ds, "ANTHROPIC_API_KEY") is None
+        assert get_secret_sync(ds, "NOT_REGISTERED") is None
+        monkeypatch.setenv("DATASETTE_SECRETS_ANTHROPIC_API_KEY", "from-env")
+        reload_environment_secrets(ds)
+        assert get_secret_sync(ds, "ANTHROPIC_API_KEY") == "from-env"
+
+        # Served from memory, with no database query
+        def fail(*args, **kwargs):
+            raise AssertionError("Database was queried")
+
+        monkeypatch.setattr(get_store(ds), "get_many", fail)
+        assert get_secret_sync(ds, "OPENAI_API_KEY") == "sk-sync"
+        monkeypatch.undo()
+
+        # Saving a secret wakes up the background refresh
+        await set_secret(ds, "OPENCAGE_API_KEY", "opencage")
+        for _ in range(100):
+            if get_secret_sync(ds, "OPENCAGE_API_KEY"):
+                break
+            await asyncio.sleep(0.01)
+        assert get_secret_sync(ds, "OPENCAGE_API_KEY") == "opencage"
+
+        # Changes from other processes are picked up by the next refresh
+        await set_secret(writer, "OPENAI_API_KEY", "sk-sync-2")
+        assert get_secret_sync(ds, "OPENAI_API_KEY") == "sk-sync"
+        assert await refresh_sync_secrets(ds) == 2
+        assert get_secret_sync(ds, "OPENAI_API_KEY") == "sk-sync-2"
+    finally:
+        ds._secrets_sync_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_file_store_change_detection_without_cache(
+    tmp_path, register_multiple_secrets
+):
+    path = tmp_path / "secrets.json"
+    one = file_store_datasette(path, cache=False)
+    two = file_store_datasette(path, cache=False)
+    for ds in (one, two):
+        await ds.invoke_startup()
+    assert await get_secret(two, "OPENAI_API_KEY") is None
+    await set_secret(one, "OPENAI_API_KEY", "first")
+    assert await get_secret(two, "OPENAI_API_KEY") == "first"
+    await set_secret(one, "OPENAI_API_KEY", "second")
+    assert await get_secret(two, "OPENAI_API_KEY") == "second"
+    # Writes from both processes are kept
+    await set_secret(two, "OPENCAGE_API_KEY", "opencage")
+    assert await get_secret(one, "OPENCAGE_API_KEY") == "opencage"
+    assert await get_secret(one, "OPENAI_API_KEY") == "second"
+
+
+@pytest.mark.asyncio
+async def test_usage_kept_if_write_fails(capsys):
+    written = []
+    failures = [ValueError("disk full")]
+
+    async def write_rows(rows):
+        if failures:
+            raise failures.pop()
+        written.extend(rows)
+
+    recorder = UsageRecorder(write_rows, interval=0.01, max_pending=100)
+    await recorder.record_many([1, 2], "alice")
+    await asyncio.sleep(0.05)
+    # The background flush failed, was reported and kept the updates
+    assert "usage flush failed: disk full" in capsys.readouterr().err
+    assert len(recorder) == 2
+    # Newer updates recorded since win over the ones that failed
+    await recorder.record(2, "bob")
+    assert await recorder.flush() == 2
+    assert sorted((row[2], row[1]) for row in written) == [(1, "alice"), (2, "bob")]
+    assert len(recorder) == 0